@@ -0,0 +1,135 @@
+"""
+Compare the approximate "integral" ball filter engine with the exact ball
+filter on the detection test data.
+
+Reports the time taken to walk each engine, how well the pixels marked by
+the approximate engine agree with the exact engine, and how many of the
+cells detected with each engine match up.
+"""
+import time
+from pathlib import Path
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from cellfinder_core.detect import detect
+from cellfinder_core.detect.filters.plane import TileProcessor
+from cellfinder_core.detect.filters.setup_filters import (
+    get_ball_filter,
+    setup_tile_filtering,
+)
+from cellfinder_core.tools.IO import read_with_dask
+
+data_path = (
+    Path(__file__).parents[2]
+    / "tests"
+    / "data"
+    / "integration"
+    / "detection"
+    / "crop_planes"
+    / "ch0"
+)
+voxel_sizes = (5, 2, 2)
+soma_diameter = 16
+ball_xy_size = 6
+ball_z_size = 15
+# Maximum distance between matching cells, in pixels
+max_cell_distance = 3
+
+
+def filter_planes(signal_array):
+    (
+        soma_diameter_px,
+        _,
+        ball_xy_size_px,
+        ball_z_size_px,
+    ) = detect.calculate_parameters_in_pixels(
+        voxel_sizes, soma_diameter, 100000, ball_xy_size, ball_z_size
+    )
+    clipping_value, threshold_value = setup_tile_filtering(signal_array[0])
+    tile_processor = TileProcessor(
+        clipping_value, threshold_value, soma_diameter_px, 0.2, 10
+    )
+    planes = [
+        tile_processor.get_tile_mask(np.array(plane)) for plane in signal_array
+    ]
+    return planes, soma_diameter_px, ball_xy_size_px, ball_z_size_px
+
+
+def run_ball_filter(engine, planes, soma_diameter_px, ball_xy, ball_z):
+    ball_filter = get_ball_filter(
+        plane=np.asarray(planes[0][0]),
+        soma_diameter=soma_diameter_px,
+        ball_xy_size=ball_xy,
+        ball_z_size=ball_z,
+        engine=engine,
+    )
+    marked = []
+    walk_time = 0.0
+    for plane, mask in planes:
+        ball_filter.append(plane, mask)
+        if ball_filter.ready:
+            start = time.perf_counter()
+            ball_filter.walk()
+            walk_time += time.perf_counter() - start
+            marked.append(
+                ball_filter.get_middle_plane() == ball_filter.SOMA_CENTRE_VALUE
+            )
+    return np.array(marked), walk_time
+
+
+def detect_cells(signal_array, engine):
+    cells = detect.main(
+        signal_array,
+        0,
+        -1,
+        voxel_sizes,
+        soma_diameter,
+        100000,
+        ball_xy_size,
+        ball_z_size,
+        0.6,
+        1.4,
+        0,
+        0.2,
+        10,
+        ball_filter_engine=engine,
+    )
+    return np.array([[cell.x, cell.y, cell.z] for cell in cells])
+
+
+if __name__ == "__main__":
+    signal_array = read_with_dask(str(data_path))
+    planes, soma_diameter_px, ball_xy, ball_z = filter_planes(signal_array)
+
+    # Compile the numba functions before timing
+    for engine in ["exact", "integral"]:
+        run_ball_filter(
+            engine, planes[: ball_z + 1], soma_diameter_px, ball_xy, ball_z
+        )
+
+    exact, exact_time = run_ball_filter(
+        "exact", planes, soma_diameter_px, ball_xy, ball_z
+    )
+    approx, approx_time = run_ball_filter(
+        "integral", planes, soma_diameter_px, ball_xy, ball_z
+    )
+    print(f"Exact ball filter walk time: {exact_time:.2f} s")
+    print(f"Integral ball filter walk time: {approx_time:.2f} s")
+
+    n_both = np.sum(exact & approx)
+    print(f"Marked pixels (exact): {np.sum(exact)}")
+    print(f"Marked pixels (integral): {np.sum(approx)}")
+    print(f"Marked pixel precision: {n_both / max(np.sum(approx), 1):.3f}")
+    print(f"Marked pixel recall: {n_both / max(np.sum(exact), 1):.3f}")
+
+    exact_cells = detect_cells(signal_array, "exact")
+    approx_cells = detect_cells(signal_array, "integral")
+    distances, _ = cKDTree(exact_cells).query(approx_cells)
+    n_matched = np.sum(distances <= max_cell_distance)
+    print(f"Cells (exact): {len(exact_cells)}")
+    print(f"Cells (integral): {len(approx_cells)}")
+    print(
+        f"Integral cells within {max_cell_distance} pixels of an exact "
+        f"cell: {n_matched}"
+    )
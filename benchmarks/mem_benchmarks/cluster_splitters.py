@@ -0,0 +1,97 @@
+"""
+Compare the distance transform cluster splitter with the ball filter
+cluster splitter on synthetic clusters of overlapping cells.
+
+Reports the time taken by each splitter, how many of the true cell
+centres each splitter finds, and how many of the cells found by the two
+splitters match up.
+"""
+import time
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from cellfinder_core.detect.filters.setup_filters import get_cluster_splitter
+from cellfinder_core.tools.geometry import sphere_points
+
+n_clusters = 100
+# Maximum distance between matching cells, in pixels
+max_cell_distance = 3
+
+
+def make_clusters(rng, soma_diameter, max_cells):
+    # Clusters of overlapping cells, with centres at least a soma radius
+    # apart
+    radius = soma_diameter // 2
+    clusters = []
+    true_centres = []
+    for _ in range(n_clusters):
+        n_cells = rng.integers(2, max_cells + 1)
+        centres = [np.zeros(3, dtype=np.int64)]
+        while len(centres) < n_cells:
+            centre = centres[rng.integers(len(centres))] + rng.integers(
+                -soma_diameter, soma_diameter + 1, size=3
+            )
+            distances = np.linalg.norm(np.array(centres) - centre, axis=1)
+            if np.all(distances >= radius):
+                centres.append(centre)
+        centres = np.array(centres) + 2 * soma_diameter * max_cells
+        points = np.concatenate(
+            [sphere_points(centre, radius) for centre in centres]
+        )
+        clusters.append(np.unique(points, axis=0).astype(np.uint64))
+        true_centres.append(centres)
+    return clusters, true_centres
+
+
+def n_matched(centres, reference):
+    if len(centres) == 0 or len(reference) == 0:
+        return 0
+    distances, _ = cKDTree(centres).query(reference)
+    return int(np.sum(distances <= max_cell_distance))
+
+
+def run_splitter(engine, soma_diameter, clusters):
+    split_cells = get_cluster_splitter(
+        soma_diameter=soma_diameter, engine=engine
+    )
+    # Compile the numba functions before timing
+    split_cells(clusters[0])
+    start = time.perf_counter()
+    centres = [split_cells(cluster) for cluster in clusters]
+    return centres, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    for soma_diameter, max_cells in [(8, 4), (16, 8)]:
+        clusters, true_centres = make_clusters(rng, soma_diameter, max_cells)
+        n_points = np.mean([len(cluster) for cluster in clusters])
+        print(
+            f"Soma diameter {soma_diameter}, up to {max_cells} cells per "
+            f"cluster, {n_points:.0f} points per cluster on average"
+        )
+
+        results = {}
+        for engine in ["ball", "distance"]:
+            centres, run_time = run_splitter(engine, soma_diameter, clusters)
+            results[engine] = centres
+            n_found = sum(map(len, centres))
+            n_true = sum(
+                n_matched(c, true) for c, true in zip(centres, true_centres)
+            )
+            print(f"  {engine}: {run_time:.2f} s")
+            print(
+                f"  {engine}: {n_found} cells found, {n_true} of "
+                f"{sum(map(len, true_centres))} true cells within "
+                f"{max_cell_distance} pixels"
+            )
+
+        n_agree = sum(
+            n_matched(distance, ball)
+            for distance, ball in zip(results["distance"], results["ball"])
+        )
+        print(
+            f"  Ball cells within {max_cell_distance} pixels of a distance "
+            f"cell: {n_agree} of {sum(map(len, results['ball']))}"
+        )
@@ -0,0 +1,80 @@
+"""
+Compare running the 2D filter in a pool of processes and in a pool of
+threads, by running detection on the detection test data with each
+backend.
+
+For each backend, prints:
+
+- the startup latency, which is the time until the first plane has been 2D
+  filtered and passed to the 3D filter. This includes starting the pool.
+- the throughput, in planes per second, of the rest of the planes.
+- the total detection time.
+"""
+import time
+from pathlib import Path
+
+import numpy as np
+
+from cellfinder_core.detect import detect
+from cellfinder_core.tools.IO import read_with_dask
+
+data_path = (
+    Path(__file__).parents[2]
+    / "tests"
+    / "data"
+    / "integration"
+    / "detection"
+    / "crop_planes"
+    / "ch0"
+)
+voxel_sizes = (5, 2, 2)
+backends = ["processes", "threads"]
+# Number of times to run detection with each backend. The first run is not
+# timed, as it includes numba compilation.
+n_repeats = 3
+
+
+def time_detection(signal_array, backend):
+    plane_times = []
+
+    def callback(plane):
+        plane_times.append(time.perf_counter())
+
+    start = time.perf_counter()
+    detect.main(
+        signal_array,
+        0,
+        -1,
+        voxel_sizes,
+        16,
+        100000,
+        6,
+        15,
+        0.6,
+        1.4,
+        0,
+        0.2,
+        10,
+        callback=callback,
+        backend=backend,
+    )
+    end = time.perf_counter()
+    return {
+        "startup latency (s)": plane_times[0] - start,
+        "throughput (planes/s)": (
+            (len(plane_times) - 1) / (plane_times[-1] - plane_times[0])
+        ),
+        "total (s)": end - start,
+    }
+
+
+if __name__ == "__main__":
+    signal_array = np.asarray(read_with_dask(str(data_path)))
+    for backend in backends:
+        all_times = [
+            time_detection(signal_array, backend) for _ in range(n_repeats)
+        ][1:]
+        print(f"{backend}:")
+        for measure in all_times[0]:
+            mean = np.mean([times[measure] for times in all_times])
+            print(f"  {measure}: {mean:.2f}")
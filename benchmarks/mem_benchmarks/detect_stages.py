@@ -0,0 +1,98 @@
+"""
+Time each stage of cell detection on the detection test data, running all
+the stages in a single process:
+
+1. The 2D filter (`TileProcessor.get_tile_mask`)
+2. The 3D ball filter (`BallFilter.append` and `BallFilter.walk`)
+3. Structure detection (`CellDetector.process`)
+
+Prints the mean time per plane for each stage.
+"""
+import time
+from pathlib import Path
+
+import numpy as np
+
+from cellfinder_core.detect import detect
+from cellfinder_core.detect.filters.plane import TileProcessor
+from cellfinder_core.detect.filters.setup_filters import setup_tile_filtering
+from cellfinder_core.detect.filters.volume.volume_filter import VolumeFilter
+from cellfinder_core.tools.IO import read_with_dask
+
+data_path = (
+    Path(__file__).parents[2]
+    / "tests"
+    / "data"
+    / "integration"
+    / "detection"
+    / "crop_planes"
+    / "ch0"
+)
+voxel_sizes = (5, 2, 2)
+# Number of times to run through all the planes. The first run is not
+# timed, as it includes numba compilation.
+n_repeats = 3
+
+
+def setup_filters(signal_array):
+    (
+        soma_diameter,
+        max_cluster_size,
+        ball_xy_size,
+        ball_z_size,
+    ) = detect.calculate_parameters_in_pixels(voxel_sizes, 16, 100000, 6, 15)
+    setup_params = (
+        signal_array[0],
+        soma_diameter,
+        ball_xy_size,
+        ball_z_size,
+        0.6,
+        0,
+    )
+    volume_filter = VolumeFilter(
+        soma_diameter=soma_diameter,
+        setup_params=setup_params,
+        n_planes=len(signal_array),
+        max_cluster_size=max_cluster_size,
+    )
+    clipping_value, threshold_value = setup_tile_filtering(signal_array[0])
+    tile_processor = TileProcessor(
+        clipping_value, threshold_value, soma_diameter, 0.2, 10
+    )
+    return tile_processor, volume_filter
+
+
+def time_stages(signal_array):
+    tile_processor, volume_filter = setup_filters(signal_array)
+    ball_filter = volume_filter.ball_filter
+    cell_detector = volume_filter.cell_detector
+
+    times = {"2D filter": 0.0, "ball filter": 0.0, "structure detection": 0.0}
+    previous_labels = None
+    for plane in signal_array:
+        start = time.perf_counter()
+        plane, mask = tile_processor.get_tile_mask(plane)
+        times["2D filter"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        ball_filter.append(plane, mask)
+        if not ball_filter.ready:
+            times["ball filter"] += time.perf_counter() - start
+            continue
+        ball_filter.walk()
+        middle_plane = ball_filter.get_middle_plane()
+        times["ball filter"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        previous_labels = cell_detector.process(middle_plane, previous_labels)
+        times["structure detection"] += time.perf_counter() - start
+
+    return {stage: t / len(signal_array) for stage, t in times.items()}
+
+
+if __name__ == "__main__":
+    signal_array = np.asarray(read_with_dask(str(data_path)))
+    all_times = [time_stages(signal_array) for _ in range(n_repeats)][1:]
+    for stage in all_times[0]:
+        mean_time = np.mean([times[stage] for times in all_times])
+        print(f"{stage}: {1000 * mean_time:.2f} ms per plane")
@@ -16,7 +16,7 @@ signal_array = gen_signal_array(667, 510)
 
 soma_diameter = 8
 setup_params = (
-    signal_array[0, :, :].T,
+    signal_array[0, :, :],
     soma_diameter,
     3,  # ball_xy_size,
     ball_z_size,
@@ -28,7 +28,6 @@ mp_3d_filter = VolumeFilter(
     soma_diameter=soma_diameter,
     setup_params=setup_params,
     n_planes=len(signal_array),
-    n_locks_release=1,
 )
 
 # Use random data for mask data
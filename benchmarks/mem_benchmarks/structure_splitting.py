@@ -0,0 +1,162 @@
+"""
+Compare splitting clusters of cells by rerunning a reused ball filter in
+place, with and without stopping early, against creating a new ball filter
+and volume for every run.
+
+The clusters are taken from the structure splitting test data, by running
+detection on it and recording every cluster that is split. As the test
+data only has a single cluster, it is split *n_repeats* times. The same
+comparison is also run on a larger set of synthetic clusters of
+overlapping cells.
+
+Reports the time taken to split each set of clusters, and how many
+clusters are split into the same cells as with a new ball filter for every
+run.
+"""
+import time
+from pathlib import Path
+
+import numpy as np
+
+from cellfinder_core.detect import detect
+from cellfinder_core.detect.filters.plane import TileProcessor
+from cellfinder_core.detect.filters.setup_filters import setup_tile_filtering
+from cellfinder_core.detect.filters.volume import structure_splitting
+from cellfinder_core.detect.filters.volume.structure_splitting import (
+    ball_filter_imgs,
+    split_cells,
+)
+from cellfinder_core.detect.filters.volume.volume_filter import VolumeFilter
+from cellfinder_core.tools.geometry import sphere_points
+from cellfinder_core.tools.IO import read_with_dask
+
+data_path = (
+    Path(__file__).parents[2]
+    / "tests"
+    / "data"
+    / "integration"
+    / "detection"
+    / "structure_split_test"
+    / "signal"
+)
+voxel_sizes = (5, 2.31, 2.31)
+n_repeats = 50
+n_clusters = 200
+cell_radius = 4
+
+
+def load_clusters():
+    # Run detection on the test data, keeping the points of every cluster
+    # that is split
+    signal_array = np.asarray(read_with_dask(str(data_path)))
+    (
+        soma_diameter,
+        max_cluster_size,
+        ball_xy_size,
+        ball_z_size,
+    ) = detect.calculate_parameters_in_pixels(voxel_sizes, 16, 100000, 6, 15)
+    setup_params = (
+        signal_array[0],
+        soma_diameter,
+        ball_xy_size,
+        ball_z_size,
+        0.6,
+        0,
+    )
+    volume_filter = VolumeFilter(
+        soma_diameter=soma_diameter,
+        setup_params=setup_params,
+        n_planes=len(signal_array),
+        max_cluster_size=max_cluster_size,
+    )
+    clipping_value, threshold_value = setup_tile_filtering(signal_array[0])
+    tile_processor = TileProcessor(
+        clipping_value, threshold_value, soma_diameter, 0.2, 10
+    )
+
+    clusters = []
+
+    def record_cluster(cell_points):
+        clusters.append(cell_points)
+        return split_cells(cell_points)
+
+    volume_filter.split_cells = record_cluster
+    volume_filter.process(
+        (tile_processor.get_tile_mask(plane) for plane in signal_array),
+        callback=lambda z: None,
+    )
+    return clusters
+
+
+def make_clusters(rng):
+    # Clusters of two to four overlapping cells
+    clusters = []
+    for _ in range(n_clusters):
+        n_cells = rng.integers(2, 5)
+        centres = 20 + rng.integers(-6, 7, size=(n_cells, 3))
+        points = np.concatenate(
+            [sphere_points(centre, cell_radius) for centre in centres]
+        )
+        clusters.append(np.unique(points, axis=0).astype(np.uint64))
+    return clusters
+
+
+def new_filter_iterative_ball_filter(volume, n_iter=10, stop_early=False):
+    # Creates a new ball filter, detector and volume for every run
+    ns = []
+    centres = []
+    vol = volume.copy()
+    for i in range(n_iter):
+        vol, cell_centres = ball_filter_imgs(vol, 65534, 65535)
+        vol -= 1
+        ns.append(len(cell_centres))
+        centres.append(cell_centres)
+        if len(cell_centres) == 0:
+            break
+    return ns, centres
+
+
+def split_all(clusters, **kwargs):
+    start = time.perf_counter()
+    centres = [split_cells(cluster, **kwargs) for cluster in clusters]
+    return centres, time.perf_counter() - start
+
+
+def n_same(centres, reference):
+    return sum(
+        a.shape == b.shape and np.array_equal(a, b)
+        for a, b in zip(centres, reference)
+    )
+
+
+def compare(clusters):
+    reused_iterative_ball_filter = structure_splitting.iterative_ball_filter
+    structure_splitting.iterative_ball_filter = (
+        new_filter_iterative_ball_filter
+    )
+    reference, reference_time = split_all(clusters)
+    structure_splitting.iterative_ball_filter = reused_iterative_ball_filter
+
+    reused, reused_time = split_all(clusters)
+    early, early_time = split_all(clusters, stop_early=True)
+
+    print(f"  Clusters: {len(clusters)}")
+    print(f"  New ball filter for every run: {reference_time:.2f} s")
+    print(f"  Reused ball filter: {reused_time:.2f} s")
+    print(f"  Reused ball filter, stopping early: {early_time:.2f} s")
+    print(f"  Same cells with reused ball filter: {n_same(reused, reference)}")
+    print(f"  Same cells when stopping early: {n_same(early, reference)}")
+
+
+if __name__ == "__main__":
+    datasets = {
+        "Structure splitting test data": load_clusters() * n_repeats,
+        "Synthetic clusters": make_clusters(np.random.default_rng(0)),
+    }
+
+    # Compile the numba functions before timing
+    split_all(datasets["Synthetic clusters"][:1])
+
+    for name, clusters in datasets.items():
+        print(f"{name}:")
+        compare(clusters)
@@ -0,0 +1,24 @@
+"""
+Time marking bright tiles in planes of different sizes, to show the
+per-plane overhead of TileWalker.
+"""
+import time
+
+import numpy as np
+
+from cellfinder_core.detect.filters.plane.tile_walker import TileWalker
+
+soma_diameter = 8
+plane_shapes = [(200, 200), (2000, 2000), (8000, 10000)]
+n_repeats = 10
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    for shape in plane_shapes:
+        plane = rng.integers(0, 4000, size=shape, dtype=np.uint16)
+        start = time.perf_counter()
+        for _ in range(n_repeats):
+            TileWalker(plane, soma_diameter).mark_bright_tiles()
+        call_time = (time.perf_counter() - start) / n_repeats
+        print(f"{shape}: {1000 * call_time:.2f} ms per plane")
@@ -13,20 +13,40 @@ bright points, the input data is clipped to [0, (max_val - 2)]
 - (max_val) is used to mark bright points during 3D filtering
 """
 
+import math
 import multiprocessing
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
 from datetime import datetime
-from queue import Queue
-from threading import Lock
-from typing import Callable, List, Optional, Sequence, Tuple, TypeVar
+from functools import partial
+from itertools import islice
+from typing import (
+    Callable,
+    Deque,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
 import numpy as np
 from brainglobe_utils.cells.cells import Cell
 from brainglobe_utils.general.system import get_num_processes
 
-from cellfinder_core import logger, types
+from cellfinder_core import types
 from cellfinder_core.detect.filters.plane import TileProcessor
+from cellfinder_core.detect.filters.plane.plane_filter import get_slab_size
 from cellfinder_core.detect.filters.setup_filters import setup_tile_filtering
 from cellfinder_core.detect.filters.volume.volume_filter import VolumeFilter
+from cellfinder_core.detect.plane_ring import PlaneRing
+from cellfinder_core.detect.plane_source import (
+    get_plane_source,
+    read_planes,
+    set_worker_source,
+)
 
 
 def calculate_parameters_in_pixels(
@@ -74,6 +94,13 @@ def main(
     plane_directory: Optional[str] = None,
     *,
     callback: Optional[Callable[[int], None]] = None,
+    n_ball_filter_threads: int = 1,
+    pack_planes: bool = False,
+    single_precision_filter: bool = False,
+    ball_filter_engine: str = "exact",
+    cluster_splitter: str = "ball",
+    cells_callback: Optional[Callable[[List[Cell]], None]] = None,
+    backend: str = "processes",
 ) -> List[Cell]:
     """
     Parameters
@@ -81,12 +108,49 @@ def main(
     callback : Callable[int], optional
         A callback function that is called every time a plane has finished
         being processed. Called with the plane number that has finished.
+    n_ball_filter_threads : int, optional
+        Number of threads used by the 3D ball filter, which runs in the
+        main process. The detected cells do not depend on this.
+    pack_planes : bool, optional
+        If `True`, the 2D filter passes planes to the 3D filter as bit-packed
+        masks of the bright pixels, which uses 16 times less memory and
+        gives the same cells. Planes saved with *save_planes* then only
+        contain the thresholded and cell-marked pixels.
+    single_precision_filter : bool, optional
+        If `True`, the 2D filter runs in float32 instead of float64, which
+        halves the memory it uses per plane. The filtered planes are within
+        1e-5 of the float64 filter relative to their range, so only pixels
+        right at the threshold can change.
+    ball_filter_engine : str, optional
+        The 3D ball filter to use. Either "exact", or "integral" for a much
+        faster filter that approximates the ball with boxes, which is
+        suitable for screening runs. See `get_ball_filter`.
+    cluster_splitter : str, optional
+        How clusters of cells are split. Either "ball", which reruns the
+        ball filter over each cluster, or "distance" for a much faster
+        split at the peaks of the cluster's distance transform. See
+        `get_cluster_splitter`.
+    cells_callback : Callable[list], optional
+        Called with a list of newly detected cells every time structures
+        are complete, which happens as soon as the 3D filter has moved
+        past them. All detected cells are also returned at the end.
+    backend : str, optional
+        How the 2D filter is run in parallel. Either "processes", for a
+        pool of worker processes, or "threads", for a pool of threads in
+        this process. Threads start much faster and share the input array
+        instead of copying planes to the workers, but only run in parallel
+        while the filter releases the GIL.
     """
     if not np.issubdtype(signal_array.dtype, np.integer):
         raise ValueError(
             "signal_array must be integer datatype, but has datatype "
             f"{signal_array.dtype}"
         )
+    if backend not in ("processes", "threads"):
+        raise ValueError(
+            f"Unknown backend '{backend}', must be one of "
+            "['processes', 'threads']"
+        )
     n_processes = get_num_processes(min_free_cpu_cores=n_free_cpus)
     n_ball_procs = max(n_processes - 1, 1)
     start_time = datetime.now()
@@ -128,13 +192,19 @@ def main(
         setup_params=setup_params,
         soma_size_spread_factor=soma_spread_factor,
         n_planes=len(signal_array),
-        n_locks_release=n_ball_procs,
         save_planes=save_planes,
         plane_directory=plane_directory,
         start_plane=start_plane,
         max_cluster_size=max_cluster_size,
         outlier_keep=outlier_keep,
         artifact_keep=artifact_keep,
+        n_ball_filter_threads=n_ball_filter_threads,
+        pack_planes=pack_planes,
+        ball_filter_engine=ball_filter_engine,
+        cluster_splitter=cluster_splitter,
+        cells_callback=cells_callback,
+        # Enough clusters to keep the workers busy splitting them
+        max_pending_splits=2 * n_ball_procs,
     )
 
     clipping_val, threshold_value = setup_tile_filtering(signal_array[0, :, :])
@@ -145,29 +215,104 @@ def main(
         soma_diameter,
         log_sigma_size,
         n_sds_above_mean_thresh,
+        pack_planes=pack_planes,
+        single_precision=single_precision_filter,
     )
 
-    # Force spawn context
-    mp_ctx = multiprocessing.get_context("spawn")
-    with mp_ctx.Pool(n_ball_procs) as worker_pool:
-        async_results, locks = _map_with_locks(
-            mp_tile_processor.get_tile_mask,
-            signal_array,  # type: ignore
-            worker_pool,
-        )
+    # Small planes are 2D filtered in slabs of several planes per task
+    n_planes = len(signal_array)
+    slab_size = get_slab_size(
+        signal_array.shape[1:], n_planes, n_ball_procs  # type: ignore
+    )
+    # Slabs that are being 2D filtered, or waiting to be read by the 3D
+    # filter. The 3D filter can't start until it has ball_z_size planes,
+    # and then each worker needs a slab to stay busy.
+    n_slabs_ahead = min(
+        n_ball_procs + math.ceil(ball_z_size / slab_size),
+        math.ceil(n_planes / slab_size),
+    )
+    # 2D filter workers write their output to shared memory, and only pass
+    # back where it is. There is a slot for each plane in flight, so a slot
+    # is only reused once the 3D filter has read the plane in it.
+    plane_shape, mask_shape = mp_tile_processor.get_output_shapes(
+        signal_array.shape[1:]  # type: ignore
+    )
+    plane_ring = PlaneRing(
+        n_slabs_ahead * slab_size,
+        plane_shape,
+        np.uint8 if pack_planes else signal_array.dtype,
+        mask_shape,
+    )
 
-        # Release the first set of locks for the 2D filtering
-        for i in range(min(n_ball_procs + ball_z_size, len(locks))):
-            logger.debug(f"🔓 Releasing lock for plane {i}")
-            locks[i].release()
+    try:
+        if backend == "processes":
+            # If possible, workers read their own planes, and are only sent
+            # the indices of each slab. Otherwise each slab is sent to the
+            # worker.
+            plane_source = get_plane_source(signal_array)
+            # Force spawn context
+            worker_pool: Union[
+                multiprocessing.pool.Pool, ThreadPoolExecutor
+            ] = multiprocessing.get_context("spawn").Pool(
+                n_ball_procs,
+                initializer=set_worker_source,
+                initargs=(plane_source,),
+            )
+        else:
+            # Threads read their planes straight from the input array
+            plane_source = None
+            worker_pool = ThreadPoolExecutor(n_ball_procs)
+
+        slab_args: Iterable[Tuple[int, int, Optional[types.array]]] = (
+            (
+                start,
+                min(start + slab_size, n_planes),
+                (
+                    None
+                    if plane_source is not None
+                    else signal_array[start : start + slab_size]
+                ),
+            )
+            for start in range(0, n_planes, slab_size)
+        )
 
-        # Start 3D filter
-        #
-        # This runs in the main thread, and blocks until the all the 2D and
-        # then 3D filtering has finished. As batches of planes are filtered
-        # by the 3D filter, it releases the locks of subsequent 2D filter
-        # processes.
-        cells = mp_3d_filter.process(async_results, locks, callback=callback)
+        with worker_pool:
+            slabs = _map_ahead(
+                partial(_filter_slab_into_ring, mp_tile_processor, plane_ring),
+                slab_args,
+                worker_pool,
+                n_slabs_ahead,
+            )
+
+            # Start 3D filter
+            #
+            # This runs in the main thread, and blocks until the all the 2D
+            # and then 3D filtering has finished. Each time the 3D filter
+            # has read all the planes of a slab, the 2D filtering of a later
+            # slab is started in their slots.
+            #
+            # Once their 2D filtering is done, worker processes split
+            # clusters of cells found by the 3D filter. Each worker has to
+            # compile the splitting code first, so this is only worth it
+            # with several workers. Worker threads would hold the GIL while
+            # splitting, so then clusters are split in this thread.
+            cells = mp_3d_filter.process(
+                (plane_ring[slot] for slots in slabs for slot in slots),
+                callback=callback,
+                splitting_pool=(
+                    worker_pool
+                    if isinstance(worker_pool, multiprocessing.pool.Pool)
+                    and n_ball_procs > 1
+                    else None
+                ),
+            )
+            if isinstance(worker_pool, multiprocessing.pool.Pool):
+                # Let the workers exit normally, so they close their
+                # handles to the plane ring
+                worker_pool.close()
+                worker_pool.join()
+    finally:
+        plane_ring.close()
 
     print(
         "Detection complete - all planes done in : {}".format(
@@ -181,41 +326,55 @@ Tin = TypeVar("Tin")
 Tout = TypeVar("Tout")
 
 
-def _run_func_with_lock(
-    func: Callable[[Tin], Tout], arg: Tin, lock: Lock
-) -> Tout:
+def _filter_slab_into_ring(
+    tile_processor: TileProcessor,
+    plane_ring: PlaneRing,
+    arg: Tuple[int, int, Optional[types.array]],
+) -> range:
     """
-    Run a function after acquiring a lock.
+    2D filter planes *start* to *stop* (exclusive), given as the
+    (start, stop, planes) tuple *arg*, and write the results to their
+    slots in *plane_ring*. Returns the range of slot indices.
+
+    If the planes are `None`, they are read from this worker's plane
+    source. The slab must not wrap around the end of the ring.
     """
-    lock.acquire(blocking=True)
-    return func(arg)
+    start, stop, planes = arg
+    if planes is None:
+        planes = read_planes(start, stop)
+    slot = plane_ring.slot(start)
+    slots = range(slot, slot + stop - start)
+    tile_processor.get_tile_masks(
+        planes, out=plane_ring[slots.start : slots.stop]
+    )
+    return slots
 
 
-def _map_with_locks(
+def _map_ahead(
     func: Callable[[Tin], Tout],
-    iterable: Sequence[Tin],
-    worker_pool: multiprocessing.pool.Pool,
-) -> Tuple[Queue, List[Lock]]:
+    iterable: Iterable[Tin],
+    worker_pool: Union[multiprocessing.pool.Pool, Executor],
+    n_ahead: int,
+) -> Iterator[Tout]:
     """
-    Map a function to arguments, blocking execution.
-
-    Maps *func* to args in *iterable*, but blocks all execution and
-    return a queue of asyncronous results and locks for each of the
-    results. Execution can be enabled by releasing the returned
-    locks in order.
+    Map a function to arguments in a process pool or an executor, yielding
+    the results in order.
+
+    No more than *n_ahead* tasks are submitted to *worker_pool* ahead of
+    the result that is being used. A new task is only submitted when the
+    next result is requested, so *func* can write its result to memory
+    that the previous result used, if that is needed for every *n_ahead*
+    tasks.
     """
-    # Setup a manager to handle the locks
-    m = multiprocessing.Manager()
-    # Setup one lock per argument to be mapped
-    locks = [m.Lock() for _ in range(len(iterable))]
-    [lock.acquire(blocking=False) for lock in locks]
-
-    async_results: Queue = Queue()
-
-    for arg, lock in zip(iterable, locks):
-        async_result = worker_pool.apply_async(
-            _run_func_with_lock, args=(func, arg, lock)
-        )
-        async_results.put(async_result)
-
-    return async_results, locks
+    args = iter(iterable)
+    # Functions that wait for the result of each task
+    pending: Deque[Callable[[], Tout]] = deque()
+    while True:
+        for arg in islice(args, n_ahead - len(pending)):
+            if isinstance(worker_pool, Executor):
+                pending.append(worker_pool.submit(func, arg).result)
+            else:
+                pending.append(worker_pool.apply_async(func, (arg,)).get)
+        if not pending:
+            return
+        yield pending.popleft()()
@@ -1,15 +1,92 @@
+from typing import Optional, Tuple
+
 import numpy as np
-from scipy.ndimage import gaussian_filter, laplace
+from numba import njit, prange
+from scipy.ndimage import correlate1d, gaussian_filter
 from scipy.signal import medfilt2d
 
+from cellfinder_core.tools.system import numba_threads
+
+
+class FilterBuffers:
+    """
+    Scratch planes used by `enhance_peaks`, which can be reused for any
+    number of images with the same shape and data type.
+    """
+
+    def __init__(
+        self,
+        shape: Tuple[int, ...],
+        dtype: np.dtype,
+        single_precision: bool = False,
+    ) -> None:
+        float_type = np.float32 if single_precision else np.float64
+        self.shape = shape
+        self.dtype = np.dtype(dtype)
+        self.single_precision = single_precision
+        # Median filtered image
+        self.median: np.ndarray = np.empty(shape, dtype=dtype)
+        # Image while it is being filtered, and a scratch plane for the
+        # Gaussian filter output
+        self.filtered: np.ndarray = np.empty(shape, dtype=float_type)
+        self.scratch: np.ndarray = np.empty(shape, dtype=float_type)
+        # Enhanced image, converted back to the input data type
+        self.out: np.ndarray = np.empty(shape, dtype=dtype)
+
+    def fits(
+        self, shape: Tuple[int, ...], dtype: np.dtype, single_precision: bool
+    ) -> bool:
+        """
+        Return `True` if these buffers can be used to filter images with
+        the given shape and data type.
+        """
+        return (
+            self.shape == shape
+            and self.dtype == dtype
+            and self.single_precision == single_precision
+        )
+
 
 def enhance_peaks(
-    img: np.ndarray, clipping_value: float, gaussian_sigma: float = 2.5
+    img: np.ndarray,
+    clipping_value: float,
+    gaussian_sigma: float = 2.5,
+    single_precision: bool = False,
+    n_median_threads: int = 1,
+    buffers: Optional[FilterBuffers] = None,
 ) -> np.ndarray:
+    """
+    Enhance peaks in *img* by running it through a median filter, and then
+    a Laplacian of Gaussian filter. The result is inverted and scaled to
+    [0, clipping_value].
+
+    If *single_precision* is `True`, filter in float32 instead of float64.
+    This halves the memory used per plane. The result is within
+    1e-5 * clipping_value of the float64 result.
+
+    Integer images are median filtered with `median_filter_3x3`, using
+    *n_median_threads* threads, before they are converted to floats.
+
+    All filtering is done in *buffers*, which are created if they are not
+    given. *img* is not modified. The returned image is ``buffers.out``, so
+    is overwritten the next time the same buffers are used.
+    """
     type_in = img.dtype
-    filtered_img = medfilt2d(img.astype(np.float64))
-    filtered_img = gaussian_filter(filtered_img, gaussian_sigma)
-    filtered_img = laplace(filtered_img)
+    if buffers is None:
+        buffers = FilterBuffers(img.shape, type_in, single_precision)
+    filtered_img = buffers.filtered
+    if np.issubdtype(type_in, np.integer):
+        median_filter_3x3(img, n_threads=n_median_threads, out=buffers.median)
+        filtered_img[:] = buffers.median
+    else:
+        filtered_img[:] = medfilt2d(img.astype(filtered_img.dtype))
+
+    gaussian_filter(filtered_img, gaussian_sigma, output=buffers.scratch)
+    # Same as scipy.ndimage.laplace, which allocates a temporary plane for
+    # the second derivative along x
+    correlate1d(buffers.scratch, [1, -2, 1], axis=0, output=filtered_img)
+    correlate1d(buffers.scratch, [1, -2, 1], axis=1, output=buffers.scratch)
+    filtered_img += buffers.scratch
     filtered_img *= -1
 
     filtered_img -= filtered_img.min()
@@ -17,4 +94,98 @@ def enhance_peaks(
 
     # To leave room to label in the 3d detection.
     filtered_img *= clipping_value
-    return filtered_img.astype(type_in)
+    np.copyto(buffers.out, filtered_img, casting="unsafe")
+    return buffers.out
+
+
+def median_filter_3x3(
+    img: np.ndarray, n_threads: int = 1, out: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """
+    Run a 3x3 median filter over the 2D integer image *img*.
+
+    Pixels outside the image are taken to be zero, so this gives exactly
+    the same result as `scipy.signal.medfilt2d`, without converting the
+    image to floats or sorting each window.
+
+    If *n_threads* is larger than one, rows are filtered in parallel.
+    If *out* is given, the filtered image is written to it.
+    """
+    filtered_img = np.empty_like(img) if out is None else out
+    if n_threads > 1:
+        with numba_threads(n_threads) as n_threads:
+            _median_3x3_parallel(img, filtered_img, 4 * n_threads)
+    else:
+        _median_3x3_rows(img, filtered_img, 0, img.shape[0])
+    return filtered_img
+
+
+@njit(cache=True, nogil=True)
+def _sort3(a: int, b: int, c: int) -> Tuple[int, int, int]:
+    """
+    Sort three values with a three comparator sorting network.
+    """
+    if a > b:
+        a, b = b, a
+    if b > c:
+        b, c = c, b
+    if a > b:
+        a, b = b, a
+    return a, b, c
+
+
+@njit(cache=True, nogil=True)
+def _median_3x3_rows(
+    img: np.ndarray, out: np.ndarray, y_start: int, y_stop: int
+) -> None:
+    """
+    Median filter rows [y_start, y_stop) of *img* into *out*.
+
+    The three pixels in each column of the window are sorted once, and
+    reused as the window moves along the row. The median of the window is
+    then the median of the largest of the column minimums, the median of
+    the column medians, and the smallest of the column maximums.
+    """
+    height, width = img.shape
+    zero = img.dtype.type(0)
+    for y in range(y_start, y_stop):
+        # Sorted (low, mid, high) of the columns left of, at, and right of x
+        left_lo, left_mid, left_hi = zero, zero, zero
+        above = img[y - 1, 0] if y > 0 else zero
+        below = img[y + 1, 0] if y < height - 1 else zero
+        lo, mid, hi = _sort3(above, img[y, 0], below)
+        for x in range(width):
+            if x < width - 1:
+                above = img[y - 1, x + 1] if y > 0 else zero
+                below = img[y + 1, x + 1] if y < height - 1 else zero
+                right_lo, right_mid, right_hi = _sort3(
+                    above, img[y, x + 1], below
+                )
+            else:
+                right_lo, right_mid, right_hi = zero, zero, zero
+
+            max_lo = max(left_lo, lo, right_lo)
+            min_hi = min(left_hi, hi, right_hi)
+            _, med_mid, _ = _sort3(left_mid, mid, right_mid)
+            _, out[y, x], _ = _sort3(max_lo, med_mid, min_hi)
+
+            left_lo, left_mid, left_hi = lo, mid, hi
+            lo, mid, hi = right_lo, right_mid, right_hi
+
+
+@njit(parallel=True)
+def _median_3x3_parallel(
+    img: np.ndarray, out: np.ndarray, n_bands: int
+) -> None:
+    """
+    Run `_median_3x3_rows` over *n_bands* bands of rows in parallel.
+    """
+    height = img.shape[0]
+    n_bands = min(height, n_bands)
+    for band in prange(n_bands):
+        _median_3x3_rows(
+            img,
+            out,
+            band * height // n_bands,
+            (band + 1) * height // n_bands,
+        )
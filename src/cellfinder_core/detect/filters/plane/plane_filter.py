@@ -1,14 +1,24 @@
+import math
 from dataclasses import dataclass
-from threading import Lock
+from threading import Lock, local
 from typing import Optional, Tuple
 
 import dask.array as da
 import numpy as np
+from numba import njit
 
 from cellfinder_core import types
-from cellfinder_core.detect.filters.plane.classical_filter import enhance_peaks
+from cellfinder_core.detect.filters.plane.classical_filter import (
+    FilterBuffers,
+    enhance_peaks,
+)
 from cellfinder_core.detect.filters.plane.tile_walker import TileWalker
 
+# 2D filter scratch buffers, separate for each thread
+_worker_buffers = local()
+# Number of pixels to 2D filter in each task, when the planes are small
+SLAB_PIXELS = 2**20
+
 
 @dataclass
 class TileProcessor:
@@ -20,6 +30,12 @@ class TileProcessor:
     threshold_value :
         Value used to mark bright features in the input planes after they have
         been run through the 2D filter.
+    pack_planes :
+        If `True`, return a bit-packed mask of the bright features instead of
+        the thresholded plane.
+    single_precision :
+        If `True`, run the peak enhancement filter in float32 instead of
+        float64. See `enhance_peaks`.
     """
 
     clipping_value: int
@@ -27,9 +43,31 @@ class TileProcessor:
     soma_diameter: int
     log_sigma_size: float
     n_sds_above_mean_thresh: float
+    pack_planes: bool = False
+    single_precision: bool = False
+
+    def get_output_shapes(
+        self, plane_shape: Tuple[int, int]
+    ) -> Tuple[Tuple[int, int], Tuple[int, int]]:
+        """
+        Get the shapes of the plane and of the mask that get_tile_mask()
+        returns for an input plane with shape *plane_shape*.
+        """
+        height, width = plane_shape
+        tile_size = 2 * self.soma_diameter
+        mask_shape = (
+            math.ceil(height / tile_size),
+            math.ceil(width / tile_size),
+        )
+        if self.pack_planes:
+            return (height, math.ceil(width / 8)), mask_shape
+        return (height, width), mask_shape
 
     def get_tile_mask(
-        self, plane: types.array, lock: Optional[Lock] = None
+        self,
+        plane: types.array,
+        lock: Optional[Lock] = None,
+        out: Optional[Tuple[np.ndarray, np.ndarray]] = None,
     ) -> Tuple[np.ndarray, np.ndarray]:
         """
         This thresholds the input plane, and returns a mask indicating which
@@ -41,32 +79,43 @@ class TileProcessor:
         2. Run through a peak enhancement filter (see `classical_filter.py`)
         3. Thresholded. Any values that are larger than
            (mean + stddev * self.n_sds_above_mean_thresh) are set to
-           self.threshold_value in-place.
+           self.threshold_value.
+
+        The input plane itself is not modified.
 
         Parameters
         ----------
         plane :
-            Input plane.
+            Input plane, with (y, x) axes.
         lock :
             If given, block reading the plane into memory until the lock
             can be acquired.
+        out :
+            If given, the thresholded plane and the mask are written to
+            these two arrays, which are returned, instead of to new arrays.
 
         Returns
         -------
         plane :
-            Thresholded plane.
+            Thresholded plane. If self.pack_planes is `True`, this is instead
+            a mask of the pixels over the threshold, packed along the last
+            (x) axis with `np.packbits`.
         inside_brain_tiles :
             Boolean mask indicating which tiles are inside (1) or
-            outside (0) the brain.
+            outside (0) the brain, with (y, x) axes.
         """
         laplace_gaussian_sigma = self.log_sigma_size * self.soma_diameter
-        plane = plane.T
-        np.clip(plane, 0, self.clipping_value, out=plane)
         if lock is not None:
             lock.acquire(blocking=True)
         # Read plane from a dask array into memory as a numpy array
         if isinstance(plane, da.Array):
-            plane = np.array(plane)
+            plane = np.asarray(plane)
+        # Clip into a new array, or into the output plane, so the input
+        # plane is never modified
+        if out is not None and not self.pack_planes:
+            plane = np.clip(plane, 0, self.clipping_value, out=out[0])
+        else:
+            plane = np.clip(plane, 0, self.clipping_value)
 
         # Get tiles that are within the brain
         walker = TileWalker(plane, self.soma_diameter)
@@ -75,13 +124,174 @@ class TileProcessor:
 
         # Threshold the image
         thresholded_img = enhance_peaks(
-            plane.copy(),
+            plane,
             self.clipping_value,
             gaussian_sigma=laplace_gaussian_sigma,
+            single_precision=self.single_precision,
+            buffers=get_filter_buffers(
+                plane.shape, plane.dtype, self.single_precision
+            ),
         )
-        avg = np.mean(thresholded_img)
-        sd = np.std(thresholded_img)
+        avg, sd = get_mean_sd(thresholded_img)
         threshold = avg + self.n_sds_above_mean_thresh * sd
-        plane[thresholded_img > threshold] = self.threshold_value
+        if out is not None:
+            out[1][:] = inside_brain_tiles
+            inside_brain_tiles = out[1]
+        if self.pack_planes:
+            if out is not None:
+                packed = out[0]
+            else:
+                packed = np.empty(
+                    (plane.shape[0], (plane.shape[1] + 7) // 8),
+                    dtype=np.uint8,
+                )
+            _pack_over_threshold(thresholded_img, threshold, packed)
+            return packed, inside_brain_tiles
+        _mark_over_threshold(
+            plane, thresholded_img, threshold, self.threshold_value
+        )
 
         return plane, inside_brain_tiles
+
+    def get_tile_masks(
+        self,
+        planes: types.array,
+        out: Optional[Tuple[np.ndarray, np.ndarray]] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Run `get_tile_mask` on a slab of consecutive planes, with (z, y, x)
+        axes. Filtering several small planes in one task saves the cost of
+        sending each of them to a worker on its own.
+
+        Parameters
+        ----------
+        planes :
+            Input planes, with (z, y, x) axes.
+        out :
+            If given, the thresholded planes and the masks are written to
+            these two arrays, which are returned, instead of to new arrays.
+
+        Returns
+        -------
+        planes :
+            The thresholded planes (or packed masks), stacked along the
+            first axis.
+        inside_brain_tiles :
+            The masks of the tiles inside the brain, stacked along the
+            first axis.
+        """
+        if out is None:
+            plane_shape, mask_shape = self.get_output_shapes(
+                planes.shape[1:]  # type: ignore
+            )
+            out = (
+                np.empty(
+                    (len(planes),) + plane_shape,
+                    dtype=np.uint8 if self.pack_planes else planes.dtype,
+                ),
+                np.empty((len(planes),) + mask_shape, dtype=bool),
+            )
+        for plane, plane_out, mask_out in zip(planes, *out):
+            self.get_tile_mask(plane, out=(plane_out, mask_out))
+        return out
+
+
+def get_slab_size(
+    plane_shape: Tuple[int, int], n_planes: int, n_workers: int
+) -> int:
+    """
+    Get how many planes of shape *plane_shape* to 2D filter in each task.
+
+    Small planes are filtered in slabs of about `SLAB_PIXELS` pixels, so
+    that filtering them takes much longer than sending them to a worker,
+    but never in fewer slabs than there are workers.
+    """
+    slab_size = SLAB_PIXELS // (plane_shape[0] * plane_shape[1])
+    return max(min(slab_size, n_planes // n_workers), 1)
+
+
+def get_filter_buffers(
+    shape: Tuple[int, ...], dtype: np.dtype, single_precision: bool
+) -> FilterBuffers:
+    """
+    Get the 2D filter scratch buffers for the current thread.
+
+    The buffers are created for the first plane filtered by each thread,
+    and reused for every later plane with the same shape and data type.
+    Pool workers filter planes one at a time, so each worker keeps a single
+    set of buffers for the whole stack.
+    """
+    buffers = getattr(_worker_buffers, "buffers", None)
+    if buffers is None or not buffers.fits(shape, dtype, single_precision):
+        buffers = FilterBuffers(shape, dtype, single_precision)
+        _worker_buffers.buffers = buffers
+    return buffers
+
+
+@njit(cache=True, nogil=True)
+def get_mean_sd(img: np.ndarray) -> Tuple[float, float]:
+    """
+    Get the mean and standard deviation of the 2D array *img*, in a single
+    pass over the array.
+
+    The mean and sum of squared deviations of each row are calculated
+    while the row is in cache, and then merged into the running totals
+    for all the previous rows (Chan et al.'s parallel variant of
+    Welford's algorithm). This is as accurate as `np.mean` and `np.std`,
+    without their extra passes or temporary arrays.
+    """
+    height, width = img.shape
+    n = 0
+    mean = 0.0
+    m2 = 0.0
+    for y in range(height):
+        row_sum = 0.0
+        for x in range(width):
+            row_sum += img[y, x]
+        row_mean = row_sum / width
+        row_m2 = 0.0
+        for x in range(width):
+            diff = img[y, x] - row_mean
+            row_m2 += diff * diff
+
+        n_total = n + width
+        delta = row_mean - mean
+        mean += delta * width / n_total
+        m2 += row_m2 + delta * delta * n * width / n_total
+        n = n_total
+    return mean, np.sqrt(m2 / n)
+
+
+@njit(cache=True, nogil=True)
+def _mark_over_threshold(
+    plane: np.ndarray,
+    filtered_img: np.ndarray,
+    threshold: float,
+    threshold_value: int,
+) -> None:
+    """
+    Set pixels in *plane* to *threshold_value* where *filtered_img* is over
+    *threshold*.
+    """
+    height, width = plane.shape
+    for y in range(height):
+        for x in range(width):
+            if filtered_img[y, x] > threshold:
+                plane[y, x] = threshold_value
+
+
+@njit(cache=True, nogil=True)
+def _pack_over_threshold(
+    filtered_img: np.ndarray, threshold: float, packed: np.ndarray
+) -> None:
+    """
+    Write a mask of the pixels in *filtered_img* that are over *threshold*
+    to *packed*, packed along the last (x) axis in the same way as
+    `np.packbits`.
+    """
+    height, width = filtered_img.shape
+    packed[:] = 0
+    for y in range(height):
+        for x in range(width):
+            if filtered_img[y, x] > threshold:
+                packed[y, x >> 3] |= np.uint8(1 << (7 - (x & 7)))
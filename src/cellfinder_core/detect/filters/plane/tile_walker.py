@@ -1,8 +1,8 @@
 import math
-from typing import Generator, Tuple
 
 import numpy as np
-from numba import njit
+
+from cellfinder_core.tools.array_operations import binned_mean_2d
 
 
 class TileWalker:
@@ -20,69 +20,58 @@ class TileWalker:
     bright_tiles_mask :
         An boolean array whose entries correspond to whether each tile is
         bright (1) or dark (0). The values are set in
-        self.mark_bright_tiles().
+        self.mark_bright_tiles(). Like the image, the mask has (y, x) axes.
     """
 
     def __init__(self, img: np.ndarray, soma_diameter: int) -> None:
         self.img = img
-        self.img_width, self.img_height = img.shape
+        self.img_height, self.img_width = img.shape
         self.tile_width = soma_diameter * 2
         self.tile_height = soma_diameter * 2
 
         n_tiles_width = math.ceil(self.img_width / self.tile_width)
         n_tiles_height = math.ceil(self.img_height / self.tile_height)
         self.bright_tiles_mask = np.zeros(
-            (n_tiles_width, n_tiles_height), dtype=bool
+            (n_tiles_height, n_tiles_width), dtype=bool
         )
 
-        corner_tile = img[0 : self.tile_width, 0 : self.tile_height]
+        corner_tile = img[0 : self.tile_height, 0 : self.tile_width]
         corner_intensity = np.mean(corner_tile)
         corner_sd = np.std(corner_tile)
         # add 1 to ensure not 0, as disables
         self.out_of_brain_threshold = (corner_intensity + (2 * corner_sd)) + 1
 
-    def _get_tiles(self) -> Generator[Tuple[int, int, np.ndarray], None, None]:
-        """
-        Generator that yields tiles of the 2D image.
-
-        Notes
-        -----
-        The final tile in each dimension can have a smaller size than the
-        rest of the tiles if the tile shape does not exactly divide the
-        image shape.
-        """
-        for y in range(
-            0, self.img_height - self.tile_height, self.tile_height
-        ):
-            for x in range(
-                0, self.img_width - self.tile_width, self.tile_width
-            ):
-                tile = self.img[
-                    x : x + self.tile_width, y : y + self.tile_height
-                ]
-                yield x, y, tile
-
     def mark_bright_tiles(self) -> None:
         """
-        Loop through tiles, and if the average value of a tile is
-        greater than the intensity threshold mark the tile as bright
-        in self.bright_tiles_mask.
+        Mark tiles whose average value is greater than the intensity
+        threshold as bright in self.bright_tiles_mask.
+
+        The means of all the tiles are computed in one binned reduction.
+        Tiles in the last row and column are never marked, even if they
+        are complete.
         """
         threshold = self.out_of_brain_threshold
         if threshold == 0:
             return
 
-        for x, y, tile in self._get_tiles():
-            if not is_low_average(tile, threshold):
-                mask_x = x // self.tile_width
-                mask_y = y // self.tile_height
-                self.bright_tiles_mask[mask_x, mask_y] = True
-
+        n_tiles_height = len(
+            range(0, self.img_height - self.tile_height, self.tile_height)
+        )
+        n_tiles_width = len(
+            range(0, self.img_width - self.tile_width, self.tile_width)
+        )
+        if n_tiles_height == 0 or n_tiles_width == 0:
+            return
 
-@njit
-def is_low_average(tile: np.ndarray, threshold: float) -> bool:
-    """
-    Return `True` if the average value of *tile* is below *threshold*.
-    """
-    avg = np.mean(tile)
-    return avg < threshold
+        # Only complete tiles are left, so there is no zero padding
+        tile_means = binned_mean_2d(
+            self.img[
+                : n_tiles_height * self.tile_height,
+                : n_tiles_width * self.tile_width,
+            ],
+            self.tile_height,
+            self.tile_width,
+        )
+        self.bright_tiles_mask[:n_tiles_height, :n_tiles_width] = (
+            tile_means >= threshold
+        )
@@ -1,12 +1,20 @@
 import math
-from typing import Tuple
+from functools import partial
+from typing import Callable, Tuple
 
 import numpy as np
 
 from cellfinder_core.detect.filters.volume.ball_filter import BallFilter
+from cellfinder_core.detect.filters.volume.integral_ball_filter import (
+    IntegralBallFilter,
+)
 from cellfinder_core.detect.filters.volume.structure_detection import (
     CellDetector,
 )
+from cellfinder_core.detect.filters.volume.structure_splitting import (
+    split_cells,
+    split_cells_distance_transform,
+)
 from cellfinder_core.tools.tools import get_max_possible_value
 
 
@@ -17,7 +25,27 @@ def get_ball_filter(
     ball_xy_size: int,
     ball_z_size: int,
     ball_overlap_fraction: float = 0.6,
+    n_threads: int = 1,
+    packed: bool = False,
+    engine: str = "exact",
 ) -> BallFilter:
+    """
+    Set up a ball filter for planes with the same shape and data type as
+    *plane*.
+
+    *engine* is one of:
+
+    - ``"exact"``: `BallFilter`.
+    - ``"integral"``: `IntegralBallFilter`, which approximates the ball with
+      boxes and is much faster, but marks slightly different pixels.
+    """
+    engines = {"exact": BallFilter, "integral": IntegralBallFilter}
+    if engine not in engines:
+        raise ValueError(
+            f"Unknown ball filter engine '{engine}', must be one of "
+            f"{list(engines)}"
+        )
+
     # thrsh_val is used to clip the data in plane to make sure
     # a number is available to mark cells. soma_centre_val is the
     # number used to mark cells.
@@ -28,7 +56,7 @@ def get_ball_filter(
     tile_width = soma_diameter * 2
     plane_height, plane_width = plane.shape
 
-    ball_filter = BallFilter(
+    ball_filter = engines[engine](
         plane_width,
         plane_height,
         ball_xy_size,
@@ -38,16 +66,63 @@ def get_ball_filter(
         tile_step_height=tile_width,
         threshold_value=thrsh_val,
         soma_centre_value=soma_centre_val,
+        n_threads=n_threads,
+        packed=packed,
     )
     return ball_filter
 
 
 def get_cell_detector(
-    *, plane_shape: Tuple[int, int], ball_z_size: int, z_offset: int = 0
+    *,
+    plane_shape: Tuple[int, int],
+    ball_z_size: int,
+    z_offset: int = 0,
+    max_coords_size: int = 0,
 ) -> CellDetector:
     plane_height, plane_width = plane_shape
     start_z = z_offset + int(math.floor(ball_z_size / 2))
-    return CellDetector(plane_width, plane_height, start_z=start_z)
+    return CellDetector(
+        plane_width,
+        plane_height,
+        start_z=start_z,
+        max_coords_size=max_coords_size,
+    )
+
+
+def get_cluster_splitter(
+    *,
+    soma_diameter: int,
+    outlier_keep: bool = False,
+    engine: str = "ball",
+) -> Callable[[np.ndarray], np.ndarray]:
+    """
+    Set up a function that splits the points of a cluster of cells, and
+    returns the centres of the cells.
+
+    *engine* is one of:
+
+    - ``"ball"``: `split_cells`, which reruns the ball filter over the
+      cluster.
+    - ``"distance"``: `split_cells_distance_transform`, which finds peaks of
+      the distance transform of the cluster, keeping only the highest peak
+      within half a soma diameter along every axis. This is much faster on
+      large clusters, but finds slightly different cells.
+
+    The returned function can be pickled, so it can be run by a
+    multiprocessing pool.
+    """
+    if engine == "ball":
+        return partial(split_cells, outlier_keep=outlier_keep)
+    elif engine == "distance":
+        return partial(
+            split_cells_distance_transform,
+            min_distance=soma_diameter // 2,
+            outlier_keep=outlier_keep,
+        )
+    raise ValueError(
+        f"Unknown cluster splitter engine '{engine}', must be one of "
+        f"{['ball', 'distance']}"
+    )
 
 
 def setup_tile_filtering(plane: np.ndarray) -> Tuple[int, int]:
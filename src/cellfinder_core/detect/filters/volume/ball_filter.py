@@ -1,10 +1,17 @@
+from typing import Optional
+
 import numpy as np
-from numba import njit
+from numba import njit, prange
 
 from cellfinder_core.tools.array_operations import bin_mean_3d
 from cellfinder_core.tools.geometry import make_sphere
+from cellfinder_core.tools.system import numba_threads
 
 DEBUG = False
+# Number of bands of rows that are split up between each thread when
+# walking the ball filter in parallel. Using several bands per thread
+# helps balance the load when some bands are mostly outside the brain.
+N_BANDS_PER_THREAD = 4
 
 
 class BallFilter:
@@ -15,6 +22,9 @@ class BallFilter:
     of a *ball_z_size* stack of planes, and marks pixels in the middle
     plane of the stack that have a high enough intensity within the
     spherical kernel.
+
+    Planes, tile masks and the kernel are all stored with (z, y, x) axes,
+    so that walking the ball along x reads contiguous memory.
     """
 
     def __init__(
@@ -28,6 +38,8 @@ class BallFilter:
         tile_step_height: int,
         threshold_value: int,
         soma_centre_value: int,
+        n_threads: int = 1,
+        packed: bool = False,
     ):
         """
         Parameters
@@ -52,12 +64,26 @@ class BallFilter:
             a high intensity.
         soma_centre_value :
             Value used to mark pixels with a high enough intensity.
+        n_threads :
+            Number of threads used to walk the ball across the planes. If
+            larger than one, bands of rows are filtered in parallel. This
+            marks exactly the same pixels as the serial walk.
+        packed :
+            If `True`, planes are appended as a bit-packed mask of the pixels
+            that are over *threshold_value*, packed along the last (x) axis
+            with `np.packbits`. This uses 16 times less memory than storing
+            16-bit planes. As only bright pixels are stored, other pixel
+            values are set to zero in planes returned by get_middle_plane().
         """
         self.ball_xy_size = ball_xy_size
         self.ball_z_size = ball_z_size
         self.overlap_fraction = overlap_fraction
         self.tile_step_width = tile_step_width
         self.tile_step_height = tile_step_height
+        self.n_threads = n_threads
+        self.packed = packed
+        self.plane_width = plane_width
+        self.plane_height = plane_height
 
         self.THRESHOLD_VALUE = threshold_value
         self.SOMA_CENTRE_VALUE = soma_centre_value
@@ -87,40 +113,107 @@ class BallFilter:
             upscaled_ball_centre_position,
         )
         sphere_kernel = sphere_kernel.astype(np.float64)
-        self.kernel = bin_mean_3d(
-            sphere_kernel,
-            bin_height=upscale_factor,
-            bin_width=upscale_factor,
-            bin_depth=upscale_factor,
+        # Reorder from (x, y, z) to (z, y, x)
+        self.kernel = np.ascontiguousarray(
+            bin_mean_3d(
+                sphere_kernel,
+                bin_height=upscale_factor,
+                bin_width=upscale_factor,
+                bin_depth=upscale_factor,
+            ).transpose()
         )
 
         assert (
-            self.kernel.shape[2] == ball_z_size
+            self.kernel.shape[0] == ball_z_size
         ), "Kernel z dimension should be {}, got {}".format(
-            ball_z_size, self.kernel.shape[2]
+            ball_z_size, self.kernel.shape[0]
         )
 
         self.overlap_threshold = np.sum(self.overlap_fraction * self.kernel)
 
         # Stores the current planes that are being filtered
-        self.volume = np.empty(
-            (plane_width, plane_height, ball_z_size), dtype=np.uint16
-        )
+        if packed:
+            self.volume = np.empty(
+                (ball_z_size, plane_height, int(np.ceil(plane_width / 8))),
+                dtype=np.uint8,
+            )
+        else:
+            self.volume = np.empty(
+                (ball_z_size, plane_height, plane_width), dtype=np.uint16
+            )
+        # Pixels in the middle plane marked by the last walk, if they are not
+        # stored in volume itself
+        self.marks: Optional[np.ndarray] = None
         # Index of the middle plane in the volume
         self.middle_z_idx = int(np.floor(ball_z_size / 2))
 
+        # Sparse version of the kernel, used when walking the ball filter.
+        #
+        # Only the kernel entries with non-zero weight are kept, as a list of
+        # (z, y, x) offsets and their weights. These are sorted from the
+        # heaviest to the lightest weight, so the overlap test reaches its
+        # decision after checking as few pixels as possible.
+        offsets = np.argwhere(self.kernel > 0)
+        weights = self.kernel[tuple(offsets.T)]
+        # Sort by descending weight, and then by distance from the middle
+        # plane
+        order = np.lexsort(
+            (
+                offsets[:, 1],
+                offsets[:, 2],
+                np.abs(offsets[:, 0] - self.middle_z_idx),
+                -weights,
+            )
+        )
+        self.kernel_offsets = np.ascontiguousarray(
+            offsets[order], dtype=np.int64
+        )
+        self.kernel_weights = np.ascontiguousarray(weights[order])
+        # Total kernel weight left to check before checking each offset
+        self.remaining_kernel_weight = np.flip(
+            np.cumsum(np.flip(self.kernel_weights))
+        ).copy()
+
         # TODO: lazy initialisation
         self.inside_brain_tiles = np.empty(
             (
-                int(np.ceil(plane_width / tile_step_width)),
-                int(np.ceil(plane_height / tile_step_height)),
                 ball_z_size,
+                int(np.ceil(plane_height / tile_step_height)),
+                int(np.ceil(plane_width / tile_step_width)),
             ),
             dtype=bool,
         )
+        # Number of bright pixels in each tile of each plane in volume, and
+        # the total over all the planes. Used to skip tiles where there
+        # aren't enough bright pixels under the ball for any pixel to be
+        # marked.
+        self.tile_bright_counts = np.zeros(
+            self.inside_brain_tiles.shape, dtype=np.int64
+        )
+        self.window_bright_counts = np.zeros(
+            self.inside_brain_tiles.shape[1:], dtype=np.int64
+        )
         # Stores the z-index in volume at which new planes are inserted when
-        # append() is called
+        # append() is called, until the volume has been filled for the
+        # first time
+        self.__current_z = -1
+        # volume and inside_brain_tiles are used as circular buffers along
+        # the z axis. Once the volume is full, each new plane overwrites the
+        # oldest one, and the z-index of the oldest plane moves along by one.
+        # This maps the z-index of planes in stack order (oldest first) to
+        # their z-index in volume/inside_brain_tiles.
+        self.z_map = np.arange(ball_z_size, dtype=np.int64)
+
+    def reset(self) -> None:
+        """
+        Remove all appended planes, so the filter can be reused for a new
+        series of planes with the same shape.
+        """
         self.__current_z = -1
+        self.z_map = np.arange(self.ball_z_size, dtype=np.int64)
+        self.tile_bright_counts[:] = 0
+        self.window_bright_counts[:] = 0
+        self.marks = None
 
     @property
     def ready(self) -> bool:
@@ -135,43 +228,76 @@ class BallFilter:
         """
         if DEBUG:
             assert [e for e in plane.shape[:2]] == [
-                e for e in self.volume.shape[:2]
+                e for e in self.volume.shape[1:]
             ], 'plane shape mismatch, expected "{}", got "{}"'.format(
-                [e for e in self.volume.shape[:2]],
+                [e for e in self.volume.shape[1:]],
                 [e for e in plane.shape[:2]],
             )
             assert [e for e in mask.shape[:2]] == [
-                e for e in self.inside_brain_tiles.shape[:2]
+                e for e in self.inside_brain_tiles.shape[1:]
             ], 'mask shape mismatch, expected"{}", got {}"'.format(
-                [e for e in self.inside_brain_tiles.shape[:2]],
+                [e for e in self.inside_brain_tiles.shape[1:]],
                 [e for e in mask.shape[:2]],
             )
         if not self.ready:
             self.__current_z += 1
+            z = self.__current_z
         else:
-            # Shift everything down by one to make way for the new plane
-            self.volume = np.roll(
-                self.volume, -1, axis=2
-            )  # WARNING: not in place
-            self.inside_brain_tiles = np.roll(
-                self.inside_brain_tiles, -1, axis=2
-            )
+            # Overwrite the oldest plane, which then becomes the newest one.
+            # Only the (ball_z_size long) z_map is shifted, instead of all
+            # the data in the volume.
+            z = self.z_map[0]
+            self.z_map = np.roll(self.z_map, -1)
         # Add the new plane to the top of volume and inside_brain_tiles
-        self.volume[:, :, self.__current_z] = plane[:, :]
-        self.inside_brain_tiles[:, :, self.__current_z] = mask[:, :]
+        self.volume[z] = plane
+        self.inside_brain_tiles[z] = mask
+        self._update_bright_counts(z)
+
+    def _update_bright_counts(self, z: int) -> None:
+        """
+        Recount the bright pixels in each tile of plane *z* in volume, and
+        update the total counts over all the planes.
+
+        Called whenever plane *z* changes, after a plane is appended and
+        after it is marked by walk(). Subclasses that don't use the tile
+        counts override this to keep their own summary of the bright pixels
+        up to date instead.
+        """
+        self.window_bright_counts -= self.tile_bright_counts[z]
+        _count_bright_tiles(
+            self.volume,
+            z,
+            self.plane_width,
+            self.plane_height,
+            self.packed,
+            self.THRESHOLD_VALUE,
+            self.tile_step_width,
+            self.tile_step_height,
+            self.tile_bright_counts[z],
+        )
+        self.window_bright_counts += self.tile_bright_counts[z]
 
     def get_middle_plane(self) -> np.ndarray:
         """
         Get the plane in the middle of self.volume.
         """
-        z = self.middle_z_idx
-        return np.array(self.volume[:, :, z], dtype=np.uint16)
+        z = self.z_map[self.middle_z_idx]
+        if not self.packed:
+            return np.array(self.volume[z], dtype=np.uint16)
+
+        bright = np.unpackbits(
+            self.volume[z], axis=-1, count=self.plane_width
+        ).astype(bool)
+        plane = np.zeros((self.plane_height, self.plane_width), np.uint16)
+        plane[bright] = self.THRESHOLD_VALUE
+        if self.marks is not None:
+            plane[self.marks] = self.SOMA_CENTRE_VALUE
+        return plane
 
     def walk(self) -> None:  # Highly optimised because most time critical
-        ball_radius = self.ball_xy_size // 2
         # Get extents of image that are covered by tiles
         tile_mask_covered_img_width = (
-            self.inside_brain_tiles.shape[0] * self.tile_step_width
+            self.inside_brain_tiles.shape[2] * self.tile_step_width
         )
         tile_mask_covered_img_height = (
             self.inside_brain_tiles.shape[1] * self.tile_step_height
@@ -180,70 +306,182 @@ class BallFilter:
         max_width = tile_mask_covered_img_width - self.ball_xy_size
         max_height = tile_mask_covered_img_height - self.ball_xy_size
 
-        _walk(
-            max_height,
-            max_width,
-            self.tile_step_width,
-            self.tile_step_height,
-            self.inside_brain_tiles,
-            self.volume,
-            self.kernel,
-            ball_radius,
-            self.middle_z_idx,
-            self.overlap_threshold,
-            self.THRESHOLD_VALUE,
-            self.SOMA_CENTRE_VALUE,
-        )
+        # Pixels marked by the walk, or None if they are marked in volume
+        # directly
+        marks: Optional[np.ndarray]
+        if self.n_threads > 1:
+            with numba_threads(self.n_threads) as n_threads:
+                marks = _walk_parallel(
+                    max_height,
+                    max_width,
+                    self.plane_width,
+                    self.plane_height,
+                    self.tile_step_width,
+                    self.tile_step_height,
+                    self.inside_brain_tiles,
+                    self.window_bright_counts,
+                    self.volume,
+                    self.packed,
+                    self.kernel_offsets,
+                    self.kernel_weights,
+                    self.remaining_kernel_weight,
+                    self.ball_xy_size,
+                    self.z_map,
+                    self.middle_z_idx,
+                    self.overlap_threshold,
+                    self.THRESHOLD_VALUE,
+                    N_BANDS_PER_THREAD * n_threads,
+                )
+        else:
+            # Bits in a packed volume can't be set to SOMA_CENTRE_VALUE, so
+            # record marks separately
+            marks = (
+                np.zeros((self.plane_height, self.plane_width), dtype=bool)
+                if self.packed
+                else None
+            )
+            _walk(
+                0,
+                max_height,
+                max_width,
+                self.plane_width,
+                self.plane_height,
+                self.tile_step_width,
+                self.tile_step_height,
+                self.inside_brain_tiles,
+                self.window_bright_counts,
+                np.zeros_like(self.window_bright_counts),
+                self.volume,
+                self.packed,
+                self.kernel_offsets,
+                self.kernel_weights,
+                self.remaining_kernel_weight,
+                self.ball_xy_size,
+                self.z_map,
+                self.middle_z_idx,
+                self.overlap_threshold,
+                self.THRESHOLD_VALUE,
+                self.SOMA_CENTRE_VALUE,
+                marks,
+            )
+
+        if marks is not None:
+            _set_marks(
+                self.volume,
+                marks,
+                self.z_map[self.middle_z_idx],
+                self.packed,
+                self.SOMA_CENTRE_VALUE,
+            )
+        self.marks = marks if self.packed else None
+        # Marked pixels are bright in later walks
+        self._update_bright_counts(self.z_map[self.middle_z_idx])
+
+
+@njit(cache=True)
+def _is_bright(
+    volume: np.ndarray,
+    x: int,
+    y: int,
+    z: int,
+    packed: bool,
+    THRESHOLD_VALUE: int,
+) -> bool:
+    """
+    Return `True` if the pixel at (x, y, z) in *volume* is over
+    THRESHOLD_VALUE.
+
+    If *packed* is `True`, *volume* is a bit-packed mask of the pixels that
+    are over THRESHOLD_VALUE, packed along the last (x) axis.
+    """
+    if packed:
+        return (volume[z, y, x >> 3] >> (7 - (x & 7))) & 1 != 0
+    return volume[z, y, x] >= THRESHOLD_VALUE
 
 
 @njit(cache=True)
 def _cube_overlaps(
-    cube: np.ndarray,
+    volume: np.ndarray,
+    x_start: int,
+    y_start: int,
+    plane_width: int,
+    plane_height: int,
+    packed: bool,
     overlap_threshold: float,
     THRESHOLD_VALUE: int,
-    kernel: np.ndarray,
+    kernel_offsets: np.ndarray,
+    kernel_weights: np.ndarray,
+    remaining_kernel_weight: np.ndarray,
+    z_map: np.ndarray,
+    middle_z: int,
+    marks: Optional[np.ndarray],
+    marks_y_start: int,
 ) -> bool:  # Highly optimised because most time critical
     """
-    For each pixel in cube that is greater than THRESHOLD_VALUE, sum
-    up the corresponding pixels in *kernel*. If the total is less than
-    overlap_threshold, return False, otherwise return True.
+    For each pixel in the kernel-sized cube of *volume* starting at
+    (x_start, y_start) that is greater than THRESHOLD_VALUE, sum up the
+    corresponding weights in the kernel. If the total is greater than
+    overlap_threshold, return True, otherwise return False.
+
+    The kernel entries are checked in the order they are given, and
+    checking stops as soon as the result is known:
 
-    Halfway through scanning the z-planes, if the total overlap is
-    less than 0.4 * overlap_threshold, this will return False early
-    without scanning the second half of the z-planes.
+    - True is returned as soon as the total goes over overlap_threshold.
+    - False is returned if adding all the kernel weight that is left to check
+      could not take the total over overlap_threshold.
 
     Parameters
     ----------
-    cube :
+    volume :
         3D array.
+    x_start, y_start :
+        Corner of the cube in *volume*.
+    plane_width, plane_height :
+        Width/height of the planes in *volume*. The cube is cropped at the
+        edges of the planes.
+    packed :
+        Whether *volume* is bit-packed (see `_is_bright`).
     overlap_threshold :
         Threshold above which to return True.
     THRESHOLD_VALUE :
         Value above which a pixel is marked as being part of a cell.
-    kernel :
-        3D array, with the same shape as *cube*.
+    kernel_offsets :
+        (n, 3) array of the (z, y, x) offsets of the kernel entries.
+    kernel_weights :
+        The weights of the kernel entries.
+    remaining_kernel_weight :
+        Total weight of the kernel entries left to check before checking
+        each entry.
+    z_map :
+        Mapping from kernel z offsets to z-indices in *volume*.
+    middle_z :
+        z-index of the middle plane in *volume*.
+    marks :
+        If given, a 2D array covering the middle plane from row
+        *marks_y_start* onwards. Pixels in the middle plane which are set in
+        *marks* are treated as being over THRESHOLD_VALUE.
     """
-    current_overlap_value = 0
+    current_overlap_value = 0.0
 
-    middle = np.floor(cube.shape[2] / 2) + 1
-    halfway_overlap_thresh = (
-        overlap_threshold * 0.4
-    )  # FIXME: do not hard code value
-
-    for z in range(cube.shape[2]):
-        # TODO: OPTIMISE: step from middle to outer boundaries to check
-        # more data first
-        #
-        # If halfway through the array, and the overlap value isn't more than
-        # 0.4 * the overlap threshold, return
-        if z == middle and current_overlap_value < halfway_overlap_thresh:
-            return False  # DEBUG: optimisation attempt
-        for y in range(cube.shape[1]):
-            for x in range(cube.shape[0]):
-                # includes self.SOMA_CENTRE_VALUE
-                if cube[x, y, z] >= THRESHOLD_VALUE:
-                    current_overlap_value += kernel[x, y, z]
-    return current_overlap_value > overlap_threshold
+    for i in range(kernel_weights.shape[0]):
+        if (
+            current_overlap_value + remaining_kernel_weight[i]
+            <= overlap_threshold
+        ):
+            return False
+        x = x_start + kernel_offsets[i, 2]
+        y = y_start + kernel_offsets[i, 1]
+        if x >= plane_width or y >= plane_height:
+            continue
+        z = z_map[kernel_offsets[i, 0]]
+        # includes self.SOMA_CENTRE_VALUE
+        if _is_bright(volume, x, y, z, packed, THRESHOLD_VALUE) or (
+            marks is not None and z == middle_z and marks[y - marks_y_start, x]
+        ):
+            current_overlap_value += kernel_weights[i]
+            if current_overlap_value > overlap_threshold:
+                return True
+    return False
 
 
 @njit
@@ -260,23 +498,33 @@ def _is_tile_to_check(
     """
     x_in_mask = x // tile_step_width  # TEST: test bounds (-1 range)
     y_in_mask = y // tile_step_height  # TEST: test bounds (-1 range)
-    return inside_brain_tiles[x_in_mask, y_in_mask, middle_z]
+    return inside_brain_tiles[middle_z, y_in_mask, x_in_mask]
 
 
 @njit
 def _walk(
-    max_height: int,
+    y_start: int,
+    y_stop: int,
     max_width: int,
+    plane_width: int,
+    plane_height: int,
     tile_step_width: int,
     tile_step_height: int,
     inside_brain_tiles: np.ndarray,
+    window_bright_counts: np.ndarray,
+    mark_counts: np.ndarray,
     volume: np.ndarray,
-    kernel: np.ndarray,
-    ball_radius: int,
+    packed: bool,
+    kernel_offsets: np.ndarray,
+    kernel_weights: np.ndarray,
+    remaining_kernel_weight: np.ndarray,
+    ball_xy_size: int,
+    z_map: np.ndarray,
     middle_z: int,
     overlap_threshold: float,
     THRESHOLD_VALUE: int,
     SOMA_CENTRE_VALUE: int,
+    marks: Optional[np.ndarray],
 ) -> None:
     """
     Scan through *volume*, and mark pixels where there are enough surrounding
@@ -286,26 +534,102 @@ def _walk(
 
     Parameters
     ----------
-    max_height, max_width :
-        Maximum offsets for the ball filter.
+    y_start, y_stop :
+        Range of y offsets for the ball filter to scan.
+    max_width :
+        Maximum x offset for the ball filter.
+    plane_width, plane_height :
+        Width/height of the planes in *volume*.
     inside_brain_tiles :
         Array containing information on whether a tile is inside the brain
         or not. Tiles outside the brain are skipped.
+    window_bright_counts :
+        Number of bright pixels in each tile, summed over all the planes in
+        *volume*.
+    mark_counts :
+        Number of pixels in each tile marked by the walk that were not
+        already bright. This is updated as pixels are marked, and should be
+        initialised with the counts for any pixels already set in *marks*.
+
+        Pixels are only tested if the bright pixels in the tiles under
+        the ball could add up to more than *overlap_threshold*, so whole
+        tiles without bright pixels are skipped.
     volume :
         3D array containing the plane-filtered data.
-    kernel :
-        3D array
-    ball_radius :
-        Radius of the ball in the xy plane.
+    packed :
+        Whether *volume* is bit-packed (see `_is_bright`).
+    kernel_offsets, kernel_weights, remaining_kernel_weight :
+        Sparse representation of the kernel (see `_cube_overlaps`).
+    ball_xy_size :
+        Diameter of the ball in the xy plane.
+    z_map :
+        Mapping from z-indices in stack order (oldest plane first) to
+        z-indices in *volume* and *inside_brain_tiles*.
+    middle_z :
+        Index of the middle plane of the stack, in stack order.
     SOMA_CENTRE_VALUE :
         Value that is used to mark pixels in *volume*.
+    marks :
+        If `None`, pixels are marked by setting them to SOMA_CENTRE_VALUE
+        in *volume*. Otherwise, *volume* is not modified and pixels are
+        marked in this 2D boolean array instead, which covers all of the
+        middle plane from row *y_start* onwards.
 
     Notes
     -----
-    Warning: modifies volume in place!
+    Warning: modifies volume in place if *marks* is `None`!
     """
-    for y in range(max_height):
-        for x in range(max_width):
+    ball_radius = ball_xy_size // 2
+    # z-index of the middle plane in volume
+    middle_z = z_map[middle_z]
+    # Most bright pixels that can be under the ball without the overlap
+    # going over overlap_threshold
+    max_bright = overlap_threshold / kernel_weights[0]
+    for y in range(y_start, y_stop):
+        # Tiles under the ball
+        tile_y_start = y // tile_step_height
+        tile_y_stop = min(
+            (min(y + ball_xy_size, plane_height) - 1) // tile_step_height + 1,
+            mark_counts.shape[0],
+        )
+        # Tiles under the ball along x, and the number of bright pixels in
+        # all the tiles under the ball
+        tile_x_start = -1
+        tile_x_stop = -1
+        n_bright = 0
+        x = 0
+        while x < max_width:
+            new_tile_x_stop = min(
+                (min(x + ball_xy_size, plane_width) - 1) // tile_step_width
+                + 1,
+                mark_counts.shape[1],
+            )
+            if (
+                x // tile_step_width != tile_x_start
+                or new_tile_x_stop != tile_x_stop
+            ):
+                tile_x_start = x // tile_step_width
+                tile_x_stop = new_tile_x_stop
+                n_bright = np.sum(
+                    window_bright_counts[
+                        tile_y_start:tile_y_stop, tile_x_start:tile_x_stop
+                    ]
+                ) + np.sum(
+                    mark_counts[
+                        tile_y_start:tile_y_stop, tile_x_start:tile_x_stop
+                    ]
+                )
+            if n_bright <= max_bright:
+                # Skip to the next x where the ball covers different tiles
+                x = max(
+                    x + 1,
+                    min(
+                        tile_x_start * tile_step_width + tile_step_width,
+                        tile_x_stop * tile_step_width - ball_xy_size + 1,
+                    ),
+                )
+                continue
+
             ball_centre_x = x + ball_radius
             ball_centre_y = y + ball_radius
             if _is_tile_to_check(
@@ -315,18 +639,224 @@ def _walk(
                 tile_step_width,
                 tile_step_height,
                 inside_brain_tiles,
+            ) and _cube_overlaps(
+                volume,
+                x,
+                y,
+                plane_width,
+                plane_height,
+                packed,
+                overlap_threshold,
+                THRESHOLD_VALUE,
+                kernel_offsets,
+                kernel_weights,
+                remaining_kernel_weight,
+                z_map,
+                middle_z,
+                marks,
+                y_start,
             ):
-                cube = volume[
-                    x : x + kernel.shape[0],
-                    y : y + kernel.shape[1],
-                    :,
-                ]
-                if _cube_overlaps(
-                    cube,
-                    overlap_threshold,
+                if not _is_bright(
+                    volume,
+                    ball_centre_x,
+                    ball_centre_y,
+                    middle_z,
+                    packed,
                     THRESHOLD_VALUE,
-                    kernel,
                 ):
+                    mark_counts[
+                        ball_centre_y // tile_step_height,
+                        ball_centre_x // tile_step_width,
+                    ] += 1
+                    # The ball centre is always in one of the tiles under
+                    # the ball
+                    n_bright += 1
+                if marks is None:
                     volume[
-                        ball_centre_x, ball_centre_y, middle_z
+                        middle_z, ball_centre_y, ball_centre_x
                     ] = SOMA_CENTRE_VALUE
+                else:
+                    marks[ball_centre_y - y_start, ball_centre_x] = True
+            x += 1
+
+
+@njit(parallel=True)
+def _walk_parallel(
+    max_height: int,
+    max_width: int,
+    plane_width: int,
+    plane_height: int,
+    tile_step_width: int,
+    tile_step_height: int,
+    inside_brain_tiles: np.ndarray,
+    window_bright_counts: np.ndarray,
+    volume: np.ndarray,
+    packed: bool,
+    kernel_offsets: np.ndarray,
+    kernel_weights: np.ndarray,
+    remaining_kernel_weight: np.ndarray,
+    ball_xy_size: int,
+    z_map: np.ndarray,
+    middle_z: int,
+    overlap_threshold: float,
+    THRESHOLD_VALUE: int,
+    n_bands: int,
+) -> np.ndarray:
+    """
+    Run `_walk` over bands of rows in parallel, and find exactly the same
+    pixels to mark as a single `_walk` over all the rows.
+
+    When the serial walk tests a pixel, pixels in the previous ball radius
+    rows of the middle plane may have already been marked, and contribute
+    to the overlap. Each band therefore has to know the final marks at the
+    end of the band above it. To allow the bands to run in parallel:
+
+    1. Each band is walked with the marks of the band above it taken from
+       the previous pass (initially no marks), and its marks are recorded
+       in a separate array instead of in *volume*.
+    2. If the marks at the end of a band changed, the band below it is
+       walked again in the next pass.
+
+    After pass n, the first n bands are guaranteed to be correct, and in
+    practice only one or two passes are needed.
+
+    Parameters
+    ----------
+    n_bands :
+        Number of bands to split the rows into. Bands are never thinner
+        than the ball radius.
+
+    See `_walk` for the other parameters.
+
+    Returns
+    -------
+    marks :
+        2D boolean array of the pixels in the middle plane to mark. *volume*
+        is not modified.
+    """
+    ball_radius = ball_xy_size // 2
+    # The tiles can extend past the edge of the plane, but offsets past the
+    # edge never mark anything
+    max_height = min(max_height, plane_height)
+    # Only the marks in the last ball_radius rows of a band can change
+    # the outcome of the band below it
+    band_height = max(-(-max_height // n_bands), ball_radius, 1)
+    n_bands = -(-max_height // band_height)
+
+    # Final marks in the middle plane, in plane coordinates
+    marks = np.zeros((plane_height, plane_width), dtype=np.bool_)
+    to_walk = np.ones(n_bands, dtype=np.bool_)
+    while np.any(to_walk):
+        previous_marks = marks.copy()
+        changed = np.zeros(n_bands, dtype=np.bool_)
+        for band in prange(n_bands):
+            if to_walk[band]:
+                y_start = band * band_height
+                y_stop = min(y_start + band_height, max_height)
+                # Marks for all the rows the ball can cover in this band
+                row_stop = min(y_stop + ball_xy_size, plane_height)
+                band_marks = np.zeros(
+                    (row_stop - y_start, plane_width), dtype=np.bool_
+                )
+                # Rows marked by the end of the band above
+                n_rows_above = min(ball_radius, plane_height - y_start)
+                band_marks[:n_rows_above] = previous_marks[
+                    y_start : y_start + n_rows_above
+                ]
+                # Count all the marks the band starts with. This can count
+                # pixels that are already bright, which only makes skipping
+                # tiles a little less likely.
+                mark_counts = np.zeros_like(window_bright_counts)
+                for y in range(n_rows_above):
+                    for x in range(plane_width):
+                        if band_marks[y, x]:
+                            mark_counts[
+                                (y_start + y) // tile_step_height,
+                                x // tile_step_width,
+                            ] += 1
+                _walk(
+                    y_start,
+                    y_stop,
+                    max_width,
+                    plane_width,
+                    plane_height,
+                    tile_step_width,
+                    tile_step_height,
+                    inside_brain_tiles,
+                    window_bright_counts,
+                    mark_counts,
+                    volume,
+                    packed,
+                    kernel_offsets,
+                    kernel_weights,
+                    remaining_kernel_weight,
+                    ball_xy_size,
+                    z_map,
+                    middle_z,
+                    overlap_threshold,
+                    THRESHOLD_VALUE,
+                    0,
+                    band_marks,
+                )
+                # Rows marked by this band
+                mark_start = y_start + ball_radius
+                mark_stop = min(y_stop + ball_radius, plane_height)
+                new_marks = band_marks[ball_radius : mark_stop - y_start]
+                # Check whether the rows the band below depends on changed
+                tail_start = max(y_stop, mark_start)
+                changed[band] = np.any(
+                    new_marks[tail_start - mark_start :]
+                    != previous_marks[tail_start:mark_stop]
+                )
+                marks[mark_start:mark_stop] = new_marks
+
+        to_walk[0] = False
+        to_walk[1:] = changed[:-1]
+
+    return marks
+
+
+@njit
+def _set_marks(
+    volume: np.ndarray,
+    marks: np.ndarray,
+    z: int,
+    packed: bool,
+    SOMA_CENTRE_VALUE: int,
+) -> None:
+    """
+    Mark the pixels set in *marks* in plane *z* of *volume*.
+
+    If *volume* is bit-packed (see `_is_bright`), the pixels are marked by
+    setting their bits instead of setting them to SOMA_CENTRE_VALUE.
+    """
+    for y in range(marks.shape[0]):
+        for x in range(marks.shape[1]):
+            if marks[y, x]:
+                if packed:
+                    volume[z, y, x >> 3] |= np.uint8(1 << (7 - (x & 7)))
+                else:
+                    volume[z, y, x] = SOMA_CENTRE_VALUE
+
+
+@njit(cache=True)
+def _count_bright_tiles(
+    volume: np.ndarray,
+    z: int,
+    plane_width: int,
+    plane_height: int,
+    packed: bool,
+    THRESHOLD_VALUE: int,
+    tile_step_width: int,
+    tile_step_height: int,
+    counts: np.ndarray,
+) -> None:
+    """
+    Count the pixels over THRESHOLD_VALUE in each tile of plane *z* of
+    *volume*, and store them in the 2D array *counts*.
+    """
+    counts[:, :] = 0
+    for y in range(plane_height):
+        for x in range(plane_width):
+            if _is_bright(volume, x, y, z, packed, THRESHOLD_VALUE):
+                counts[y // tile_step_height, x // tile_step_width] += 1
@@ -1,9 +1,8 @@
 from dataclasses import dataclass
-from typing import Dict, Optional, TypeVar
+from typing import Dict, Optional, Tuple
 
 import numba.typed
 import numpy as np
-import numpy.typing as npt
 from numba import njit
 from numba.core import types
 from numba.experimental import jitclass
@@ -32,20 +31,6 @@ def get_non_zero_dtype_min(values: np.ndarray) -> int:
     return min_val
 
 
-T = TypeVar("T")
-
-
-@njit
-def traverse_dict(d: Dict[T, T], a: T) -> T:
-    """
-    Traverse d, until a is not present as a key.
-    """
-    if a in d:
-        return traverse_dict(d, d[a])
-    else:
-        return a
-
-
 @njit
 def get_structure_centre(structure: np.ndarray) -> np.ndarray:
     """
@@ -70,14 +55,23 @@ def get_structure_centre(structure: np.ndarray) -> np.ndarray:
 # Type declaration has to come outside of the class,
 # see https://github.com/numba/numba/issues/8808
 uint_2d_type = types.uint64[:, :]
+float_1d_type = types.float64[:]
+
+# Number of points that space is reserved for when a structure is created
+INITIAL_STRUCTURE_CAPACITY = 4
 
 
 spec = [
     ("z", types.uint64),
-    ("next_structure_id", types.uint64),
+    ("next_structure_id", types.int64),
     ("shape", types.UniTuple(types.int64, 2)),
-    ("obsolete_ids", DictType(types.int64, types.int64)),
-    ("coords_maps", DictType(types.uint64, uint_2d_type)),
+    ("max_coords_size", types.int64),
+    ("parents", types.int64[:]),
+    ("sizes", types.int64[:]),
+    ("labels", types.int64[:]),
+    ("last_z", types.int64[:]),
+    ("coord_sums", types.int64[:, :]),
+    ("coords_maps", DictType(types.int64, uint_2d_type)),
 ]
 
 
@@ -87,6 +81,10 @@ class CellDetector:
     A class to detect connected structures within a series of
     stacked planes.
 
+    Structures that are found to be connected are merged using a
+    union-find (disjoint set) data structure, with path compression and
+    union by size.
+
     Attributes
     ----------
     z :
@@ -96,186 +94,551 @@ class CellDetector:
         counting up from 1.
     shape :
         Shape of the planes to be processed.
-    obsolete_ids :
-        Mapping from obsolete structure IDs to the structure ID they
-        have been replaced with. This is used to keep track of structures
-        that were initially disconnected, but later connected as the planes
-        are scanned.
+    max_coords_size :
+        Structures with at least this many points stop storing their
+        coordinates, and only keep their number of points and the sum of
+        their coordinates. If 0, coordinates are always stored.
+    parents :
+        Parent of each structure ID in the union-find forest. IDs that are
+        their own parent are the roots of each set of connected IDs.
+    sizes :
+        Number of points in the structure with each root ID.
+    labels :
+        For each root ID, the smallest ID that has been merged into that
+        structure. This is the ID the structure is reported with.
+    last_z :
+        For each root ID, the z-coordinate of the last plane the structure
+        has points in.
+    coord_sums :
+        For each root ID, the sum of the (x, y, z) coordinates of the
+        points in the structure.
     coords_maps :
-        Mapping from structure ID to the coordinates of pixels within that
-        structure. Coordinates are stored in a 2D array, with the second
-        axis indexing (x, y, z) coordinates.
+        Mapping from root structure ID to the coordinates of pixels within
+        that structure. Coordinates are stored in a 2D array, with the
+        second axis indexing (x, y, z) coordinates. Space for extra points
+        is reserved at the end of each array, so only the first
+        ``sizes[id]`` rows are valid. Structures that have reached
+        ``max_coords_size`` points have an empty array.
     """
 
-    def __init__(self, width: int, height: int, start_z: int):
+    def __init__(
+        self, width: int, height: int, start_z: int, max_coords_size: int = 0
+    ):
         """
         Parameters
         ----------
         width, height
-            Shape of the planes input to self.process()
+            Shape of the planes input to self.process(). Planes have
+            (y, x) axes, so have shape (height, width).
         start_z:
             The z-coordinate of the first processed plane.
+        max_coords_size:
+            Number of points at which structures stop storing their
+            coordinates. Only the centres of these structures are then
+            available, from get_large_structure_centres(). If 0,
+            coordinates are always stored.
+        """
+        self.shape = height, width
+        self.max_coords_size = max_coords_size
+        self.reset(start_z)
+
+    def reset(self, start_z: int) -> None:
+        """
+        Remove all structures, so the detector can be reused for a new
+        series of planes, starting at z-coordinate *start_z*.
         """
-        self.shape = width, height
         self.z = start_z
         self.next_structure_id = 1
 
-        # Mapping from obsolete IDs to the IDs that they have been
-        # made obsolete by
-        self.obsolete_ids = numba.typed.Dict.empty(
-            key_type=types.int64, value_type=types.int64
+        # ID 0 is never used, as it marks pixels not in a structure
+        self.parents = np.zeros(INITIAL_STRUCTURE_CAPACITY, dtype=np.int64)
+        self.sizes = np.zeros(INITIAL_STRUCTURE_CAPACITY, dtype=np.int64)
+        self.labels = np.zeros(INITIAL_STRUCTURE_CAPACITY, dtype=np.int64)
+        self.last_z = np.zeros(INITIAL_STRUCTURE_CAPACITY, dtype=np.int64)
+        self.coord_sums = np.zeros(
+            (INITIAL_STRUCTURE_CAPACITY, 3), dtype=np.int64
         )
-        # Mapping from IDs to list of points in that structure
+        # Mapping from root IDs to the points in that structure
         self.coords_maps = numba.typed.Dict.empty(
             key_type=types.int64, value_type=uint_2d_type
         )
 
     def process(
-        self, plane: np.ndarray, previous_plane: Optional[np.ndarray]
+        self, plane: np.ndarray, previous_labels: Optional[np.ndarray]
     ) -> np.ndarray:
         """
-        Process a new plane.
+        Process a new plane, given the labels that were returned for the
+        previous plane, and return the labels of this plane.
         """
         if [e for e in plane.shape[:2]] != [e for e in self.shape]:
             raise ValueError("plane does not have correct shape")
 
-        plane = self.connect_four(plane, previous_plane)
+        labels = self.connect_four(plane, previous_labels)
         self.z += 1
-        return plane
+        return labels
 
     def connect_four(
-        self, plane: np.ndarray, previous_plane: Optional[np.ndarray]
+        self, plane: np.ndarray, previous_labels: Optional[np.ndarray]
     ) -> np.ndarray:
         """
         Perform structure labelling.
 
-        For all the pixels in the current plane, finds all structures touching
-        this pixel using the four connected (plus shape) rule and also looks at
-        the pixel at the same location in the previous plane. If structures are
-        found, they are added to the structure manager and the pixel labeled
-        accordingly.
+        Bright pixels in the current plane are first split into connected
+        components using the four connected (plus shape) rule. Each
+        component is then merged with all the structures it touches at the
+        same locations in the previous plane, and its pixels are added to
+        the merged structure in bulk.
+
+        Structure IDs are the same as labelling pixel by pixel in raster
+        order: a new ID is used for every bright pixel with no bright
+        neighbour to the left, below, or behind it.
+
+        *plane* is not modified.
 
         Returns
         -------
-        plane :
+        labels :
             Plane with pixels either set to zero (no structure) or labelled
-            with their structure ID.
+            with the root ID of their structure. This is a separate int64
+            plane, with the same type as the IDs themselves, so that IDs
+            never wrap around, however many structures there are.
         """
         SOMA_CENTRE_VALUE = np.iinfo(plane.dtype).max
-        for y in range(plane.shape[1]):
-            for x in range(plane.shape[0]):
-                if plane[x, y] == SOMA_CENTRE_VALUE:
-                    # Labels of structures below, left and behind
-                    neighbour_ids = np.zeros(3, dtype=np.uint64)
-                    # If in bounds look at neighbours
-                    if x > 0:
-                        neighbour_ids[0] = plane[x - 1, y]
-                    if y > 0:
-                        neighbour_ids[1] = plane[x, y - 1]
-                    if previous_plane is not None:
-                        neighbour_ids[2] = previous_plane[x, y]
-
-                    if is_new_structure(neighbour_ids):
-                        neighbour_ids[0] = self.next_structure_id
-                        self.next_structure_id += 1
-                    struct_id = self.add(x, y, self.z, neighbour_ids)
-                else:
-                    # reset so that grayscale value does not count as
-                    # structure in next iterations
-                    struct_id = 0
-
-                plane[x, y] = struct_id
-
-        return plane
+        run_rows, run_starts, run_stops, row_starts = _get_runs(
+            plane, SOMA_CENTRE_VALUE
+        )
+        n_runs = len(run_rows)
+        run_components, n_components = _label_runs(
+            run_starts, run_stops, row_starts
+        )
+
+        # Use a new ID for the first pixel of each run that has no bright
+        # pixel below it or behind it
+        seed_components = np.empty(n_runs, dtype=np.int64)
+        n_seeds = 0
+        for run in range(n_runs):
+            y = run_rows[run]
+            x = run_starts[run]
+            if y > 0 and plane[y - 1, x] == SOMA_CENTRE_VALUE:
+                continue
+            if previous_labels is not None and previous_labels[y, x] != 0:
+                continue
+            seed_components[n_seeds] = run_components[run]
+            n_seeds += 1
+        first_seed_id = self.reserve_ids(n_seeds)
+
+        # Merge each component with the structures it touches in the
+        # previous plane
+        component_roots = np.zeros(n_components, dtype=np.int64)
+        if previous_labels is not None:
+            for run in range(n_runs):
+                component = run_components[run]
+                y = run_rows[run]
+                last_id = 0
+                for x in range(run_starts[run], run_stops[run]):
+                    sid = previous_labels[y, x]
+                    if sid == 0 or sid == last_id:
+                        continue
+                    last_id = sid
+                    root = self.find(sid)
+                    if component_roots[component] == 0:
+                        component_roots[component] = root
+                    else:
+                        component_roots[component] = self.union(
+                            self.find(component_roots[component]), root
+                        )
+
+        # Components that don't touch any structures are new structures,
+        # with the ID of their first seed. All other seed IDs point
+        # straight at the root of their component.
+        for seed in range(n_seeds):
+            sid = first_seed_id + seed
+            component = seed_components[seed]
+            if component_roots[component] == 0:
+                self.init_structure(sid)
+                component_roots[component] = sid
+            else:
+                self.parents[sid] = self.find(component_roots[component])
+                self.sizes[sid] = 0
+                self.labels[sid] = sid
+        for component in range(n_components):
+            component_roots[component] = self.find(component_roots[component])
+
+        # Add the points of each component to its structure
+        labels = np.zeros(self.shape, dtype=np.int64)
+        component_sizes = np.zeros(n_components, dtype=np.int64)
+        for run in range(n_runs):
+            component_sizes[run_components[run]] += (
+                run_stops[run] - run_starts[run]
+            )
+        # Runs grouped by component, in raster order within each component
+        runs_by_component = np.argsort(run_components, kind="mergesort")
+        run = 0
+        for component in range(n_components):
+            root = component_roots[component]
+            n_points = component_sizes[component]
+            store_coords = self.has_coords(root)
+            if store_coords and 0 < self.max_coords_size <= (
+                self.sizes[root] + n_points
+            ):
+                self.coords_maps[root] = np.empty((0, 3), dtype=np.uint64)
+                store_coords = False
+            coords = self.coords_maps[root]
+            if store_coords:
+                coords = self.reserve(root, n_points)
+            n = self.sizes[root]
+            while (
+                run < n_runs
+                and run_components[runs_by_component[run]] == component
+            ):
+                run_idx = runs_by_component[run]
+                y = run_rows[run_idx]
+                for x in range(run_starts[run_idx], run_stops[run_idx]):
+                    if store_coords:
+                        coords[n, 0] = x
+                        coords[n, 1] = y
+                        coords[n, 2] = self.z
+                    n += 1
+                    self.coord_sums[root, 0] += x
+                    self.coord_sums[root, 1] += y
+                    labels[y, x] = root
+                run += 1
+            self.coord_sums[root, 2] += n_points * np.int64(self.z)
+            self.sizes[root] = n
+            self.last_z[root] = self.z
+
+        return labels
 
     def get_cell_centres(self) -> np.ndarray:
         return self.structures_to_cells()
 
     def get_coords_dict(self) -> Dict:
-        return self.coords_maps
+        """
+        Get a mapping from structure ID to the (x, y, z) coordinates of the
+        points in each structure, ordered by structure ID.
+
+        Structures with at least max_coords_size points are not included,
+        see get_large_structure_centres().
+        """
+        roots = np.array(list(self.coords_maps.keys()), dtype=np.int64)
+        return self.roots_to_coords_dict(roots)
 
-    def add_point(self, sid: int, point: np.ndarray) -> None:
+    def get_large_structure_centres(self) -> Dict:
         """
-        Add *point* to the structure with the given *sid*.
+        Get a mapping from structure ID to the (x, y, z) centre of each
+        structure with at least max_coords_size points, ordered by
+        structure ID.
         """
-        self.coords_maps[sid] = np.row_stack((self.coords_maps[sid], point))
+        roots = np.array(list(self.coords_maps.keys()), dtype=np.int64)
+        return self.roots_to_centres_dict(roots)
 
-    def add(
-        self, x: int, y: int, z: int, neighbour_ids: npt.NDArray[np.uint64]
-    ) -> int:
+    def pop_completed_structures(self) -> Tuple[Dict, Dict]:
         """
-        For the current coordinates takes all the neighbours and find the
-        minimum structure including obsolete structures mapping to any of
-        the neighbours recursively.
+        Remove the structures that have no points in the last processed
+        plane, and return them in the same format as `get_coords_dict`
+        and `get_large_structure_centres`.
 
-        Once the correct structure id is found, append a point with the
-        current coordinates to the coordinates map entry for the correct
-        structure. Hence each entry of the map will be a vector of all the
-        pertaining points.
+        Pixels in later planes can only connect to a structure through
+        its pixels in the last processed plane, so these structures are
+        complete.
         """
-        updated_id = self.sanitise_ids(neighbour_ids)
-        if updated_id not in self.coords_maps:
-            self.coords_maps[updated_id] = np.zeros(
-                shape=(0, 3), dtype=np.uint64
-            )
-        self.merge_structures(updated_id, neighbour_ids)
+        last_plane = np.int64(self.z) - 1
+        roots = np.array(
+            [
+                root
+                for root in self.coords_maps.keys()
+                if self.last_z[root] < last_plane
+            ],
+            dtype=np.int64,
+        )
+        coords = self.roots_to_coords_dict(roots)
+        centres = self.roots_to_centres_dict(roots)
+        for root in roots:
+            self.coords_maps.pop(root)
+        return coords, centres
 
-        # Add point for that structure
-        point = np.array([[x, y, z]], dtype=np.uint64)
-        self.add_point(updated_id, point)
-        return updated_id
+    def roots_to_coords_dict(self, roots: np.ndarray) -> Dict:
+        """
+        Get a mapping from structure ID to the valid points of each of the
+        structures with root IDs *roots*, ordered by structure ID.
+        """
+        labels = self.labels[roots]
+        coords = numba.typed.Dict.empty(
+            key_type=types.int64, value_type=uint_2d_type
+        )
+        for idx in np.argsort(labels):
+            root = roots[idx]
+            if self.has_coords(root):
+                coords[labels[idx]] = self.coords_maps[root][
+                    : self.sizes[root]
+                ]
+        return coords
+
+    def roots_to_centres_dict(self, roots: np.ndarray) -> Dict:
+        """
+        Get a mapping from structure ID to the centre of each of the
+        structures with root IDs *roots* that no longer store their
+        coordinates, ordered by structure ID.
+        """
+        labels = self.labels[roots]
+        centres = numba.typed.Dict.empty(
+            key_type=types.int64, value_type=float_1d_type
+        )
+        for idx in np.argsort(labels):
+            root = roots[idx]
+            if not self.has_coords(root):
+                # Same as get_structure_centre() on the coordinates
+                centres[labels[idx]] = np.round(
+                    self.coord_sums[root] / self.sizes[root]
+                )
+        return centres
+
+    def has_coords(self, sid: int) -> bool:
+        """
+        Whether the structure with root ID *sid* stores its coordinates.
+        """
+        return len(self.coords_maps[sid]) > 0
 
-    def sanitise_ids(self, neighbour_ids: npt.NDArray[np.uint64]) -> int:
+    def drop_coords_if_large(self, sid: int) -> None:
         """
-        Get the smallest ID of all the structures that are connected to IDs
-        in `neighbour_ids`.
+        Stop storing the coordinates of the structure with root ID *sid*
+        if it has at least max_coords_size points.
+        """
+        if self.max_coords_size == 0 or not self.has_coords(sid):
+            return
+        if self.sizes[sid] >= self.max_coords_size:
+            self.coords_maps[sid] = np.empty((0, 3), dtype=np.uint64)
 
-        For all the neighbour ids, walk up the chain of obsolescence (self.
-        obsolete_ids) to reassign the corresponding most obsolete structure
-        to the current neighbour.
+    def reserve_ids(self, n_ids: int) -> int:
+        """
+        Reserve *n_ids* new structure IDs, and return the first of them.
+        """
+        first_id = self.next_structure_id
+        self.next_structure_id += n_ids
+        n_required = first_id + n_ids
+        if n_required > len(self.parents):
+            # At least double the space for IDs
+            length = max(n_required, 2 * len(self.parents))
+            self.parents = grow(self.parents, length)
+            self.sizes = grow(self.sizes, length)
+            self.labels = grow(self.labels, length)
+            self.last_z = grow(self.last_z, length)
+            self.coord_sums = grow(self.coord_sums, length)
+        return first_id
+
+    def init_structure(self, sid: int) -> None:
+        """
+        Create a new, empty, structure with the reserved ID *sid*.
+        """
+        self.parents[sid] = sid
+        self.sizes[sid] = 0
+        self.labels[sid] = sid
+        self.coord_sums[sid] = 0
+        self.coords_maps[sid] = np.empty(
+            (INITIAL_STRUCTURE_CAPACITY, 3), dtype=np.uint64
+        )
 
-        Has no side effects on this class.
+    def find(self, sid: int) -> int:
         """
-        for i, neighbour_id in enumerate(neighbour_ids):
-            # walk up the chain of obsolescence
-            neighbour_id = int(traverse_dict(self.obsolete_ids, neighbour_id))
-            neighbour_ids[i] = neighbour_id
+        Get the root ID of the structure that *sid* has been merged into.
 
-        # Get minimum of all non-obsolete IDs
-        updated_id = get_non_zero_dtype_min(neighbour_ids)
-        return int(updated_id)
+        All IDs on the path to the root are updated to point straight at
+        the root, so that later lookups are quicker.
+        """
+        root = sid
+        while self.parents[root] != root:
+            root = self.parents[root]
+        while self.parents[sid] != root:
+            next_id = self.parents[sid]
+            self.parents[sid] = root
+            sid = next_id
+        return root
+
+    def union(self, root_a: int, root_b: int) -> int:
+        """
+        Merge the two structures with root IDs *root_a* and *root_b*, and
+        return the root ID of the merged structure.
 
-    def merge_structures(
-        self, updated_id: int, neighbour_ids: npt.NDArray[np.uint64]
-    ) -> None:
+        The points of the smaller structure are copied to the end of the
+        larger structure, unless the merged structure no longer stores its
+        coordinates.
         """
-        For all the neighbours, reassign all the points of neighbour to
-        updated_id. Then deletes the now obsolete entry from the points
-        map and add that entry to the obsolete_ids.
+        if root_a == root_b:
+            return root_a
+        if self.sizes[root_a] < self.sizes[root_b] or (
+            self.sizes[root_a] == self.sizes[root_b] and root_b < root_a
+        ):
+            root_a, root_b = root_b, root_a
+
+        n_points = self.sizes[root_b]
+        if not self.has_coords(root_b):
+            self.coords_maps[root_a] = self.coords_maps[root_b]
+        elif self.has_coords(root_a) and (
+            self.max_coords_size == 0
+            or self.sizes[root_a] + n_points < self.max_coords_size
+        ):
+            coords = self.reserve(root_a, n_points)
+            start = self.sizes[root_a]
+            coords[start : start + n_points] = self.coords_maps[root_b][
+                :n_points
+            ]
+        self.coords_maps.pop(root_b)
+
+        self.parents[root_b] = root_a
+        self.sizes[root_a] += n_points
+        self.coord_sums[root_a] += self.coord_sums[root_b]
+        self.drop_coords_if_large(root_a)
+        self.labels[root_a] = min(self.labels[root_a], self.labels[root_b])
+        self.last_z[root_a] = max(self.last_z[root_a], self.last_z[root_b])
+        return root_a
 
-        Updates:
-        - self.coords_maps
-        - self.obsolete_ids
+    def reserve(self, sid: int, n_points: int) -> np.ndarray:
         """
-        for neighbour_id in np.unique(neighbour_ids):
-            # minimise ID so if neighbour with higher ID, reassign its points
-            # to current
-            if neighbour_id > updated_id:
-                self.add_point(updated_id, self.coords_maps[neighbour_id])
-                self.coords_maps.pop(neighbour_id)
-                self.obsolete_ids[neighbour_id] = updated_id
+        Make sure the coordinates array of root ID *sid* has space for
+        *n_points* more points, and return it.
+
+        The capacity of the array is at least doubled whenever it has to be
+        grown, so appending points takes amortised constant time.
+        """
+        coords = self.coords_maps[sid]
+        n_required = self.sizes[sid] + n_points
+        if n_required > len(coords):
+            coords = grow(coords, max(n_required, 2 * len(coords)))
+            self.coords_maps[sid] = coords
+        return coords
 
     def structures_to_cells(self) -> np.ndarray:
         cell_centres = np.empty((len(self.coords_maps.keys()), 3))
-        for idx, structure in enumerate(self.coords_maps.values()):
-            p = get_structure_centre(structure)
-            cell_centres[idx] = p
+        idx = 0
+        for structure in self.get_coords_dict().values():
+            cell_centres[idx] = get_structure_centre(structure)
+            idx += 1
+        for centre in self.get_large_structure_centres().values():
+            cell_centres[idx] = centre
+            idx += 1
         return cell_centres
 
 
 @njit
-def is_new_structure(neighbour_ids: np.ndarray) -> bool:
-    for i in range(len(neighbour_ids)):
-        if neighbour_ids[i] != 0:
-            return False
-    return True
+def grow(array: np.ndarray, length: int) -> np.ndarray:
+    """
+    Return a copy of *array* with its first axis extended to *length*.
+
+    The new entries are not initialised.
+    """
+    new_array = np.empty((length,) + array.shape[1:], dtype=array.dtype)
+    new_array[: len(array)] = array
+    return new_array
+
+
+@njit
+def _get_runs(
+    plane: np.ndarray, value: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Find the runs of pixels equal to *value* along each row of *plane*.
+
+    Returns
+    -------
+    run_rows, run_starts, run_stops :
+        The y-coordinate, and first and one past the last x-coordinates of
+        each run, in raster order.
+    row_starts :
+        Index of the first run in each row, with one extra entry for the
+        end of the last row.
+    """
+    height, width = plane.shape
+    # Count the runs in each row. This is branch free, so that it is quick
+    # on mostly empty planes.
+    row_starts = np.zeros(height + 1, dtype=np.int64)
+    for y in range(height):
+        n_row_runs = 0
+        previous_bright = False
+        for x in range(width):
+            bright = plane[y, x] == value
+            n_row_runs += bright and not previous_bright
+            previous_bright = bright
+        row_starts[y + 1] = row_starts[y] + n_row_runs
+
+    n_runs = row_starts[height]
+    run_rows = np.empty(n_runs, dtype=np.int64)
+    run_starts = np.empty(n_runs, dtype=np.int64)
+    run_stops = np.empty(n_runs, dtype=np.int64)
+    for y in range(height):
+        run = row_starts[y]
+        if run == row_starts[y + 1]:
+            continue
+        x = 0
+        while x < width:
+            if plane[y, x] == value:
+                run_rows[run] = y
+                run_starts[run] = x
+                while x < width and plane[y, x] == value:
+                    x += 1
+                run_stops[run] = x
+                run += 1
+            else:
+                x += 1
+    return run_rows, run_starts, run_stops, row_starts
+
+
+@njit
+def _find_run_root(run_parents: np.ndarray, run: int) -> int:
+    root = run
+    while run_parents[root] != root:
+        root = run_parents[root]
+    while run_parents[run] != root:
+        next_run = run_parents[run]
+        run_parents[run] = root
+        run = next_run
+    return root
+
+
+@njit
+def _label_runs(
+    run_starts: np.ndarray, run_stops: np.ndarray, row_starts: np.ndarray
+) -> Tuple[np.ndarray, int]:
+    """
+    Label the connected components of a plane, from the runs of bright
+    pixels found by `_get_runs`. Runs in neighbouring rows are connected
+    if they overlap along x.
+
+    Returns
+    -------
+    run_components :
+        Component index of each run. Components are numbered in the raster
+        order of their first pixel.
+    n_components :
+        Number of components.
+    """
+    n_runs = len(run_starts)
+    run_parents = np.arange(n_runs)
+    for y in range(1, len(row_starts) - 1):
+        above = row_starts[y - 1]
+        for run in range(row_starts[y], row_starts[y + 1]):
+            # Skip runs above that end before this run starts
+            while (
+                above < row_starts[y] and run_stops[above] <= run_starts[run]
+            ):
+                above += 1
+            other = above
+            while other < row_starts[y] and run_starts[other] < run_stops[run]:
+                root_a = _find_run_root(run_parents, run)
+                root_b = _find_run_root(run_parents, other)
+                # Keep the earliest run as the root
+                if root_a < root_b:
+                    run_parents[root_b] = root_a
+                elif root_b < root_a:
+                    run_parents[root_a] = root_b
+                other += 1
+
+    run_components = np.empty(n_runs, dtype=np.int64)
+    n_components = 0
+    for run in range(n_runs):
+        root = _find_run_root(run_parents, run)
+        if root == run:
+            run_components[run] = n_components
+            n_components += 1
+        else:
+            run_components[run] = run_components[root]
+    return run_components, n_components
@@ -1,6 +1,8 @@
 from typing import List, Tuple
 
 import numpy as np
+from scipy.ndimage import distance_transform_edt
+from skimage.feature import peak_local_max
 
 from cellfinder_core import logger
 from cellfinder_core.detect.filters.volume.ball_filter import BallFilter
@@ -23,10 +25,13 @@ def get_shape(xs: np.ndarray, ys: np.ndarray, zs: np.ndarray) -> List[int]:
 def coords_to_volume(
     xs: np.ndarray, ys: np.ndarray, zs: np.ndarray, ball_radius: int = 1
 ) -> np.ndarray:
+    """
+    Create a (z, y, x) volume with the given points set to 65534.
+    """
     ball_diameter = ball_radius * 2
     # Expanded to ensure the ball fits even at the border
     expanded_shape = [
-        dim_size + ball_diameter for dim_size in get_shape(xs, ys, zs)
+        dim_size + ball_diameter for dim_size in get_shape(zs, ys, xs)
     ]
     volume = np.zeros(expanded_shape, dtype=np.uint16)
 
@@ -36,12 +41,74 @@ def coords_to_volume(
     relative_ys = np.array((ys - y_min + ball_radius), dtype=np.int64)
     relative_zs = np.array((zs - z_min + ball_radius), dtype=np.int64)
 
-    # OPTIMISE: vectorize
-    for rel_x, rel_y, rel_z in zip(relative_xs, relative_ys, relative_zs):
-        volume[rel_x, rel_y, rel_z] = 65534
+    volume[relative_zs, relative_ys, relative_xs] = 65534
     return volume
 
 
+class StructureSplitter:
+    """
+    Runs the ball filter repeatedly over the (z, y, x) volume of a
+    structure, and detects the structures left after each run.
+
+    A single ball filter and cell detector are reused for all the runs,
+    and the volume is filtered in place.
+    """
+
+    def __init__(
+        self,
+        plane_width: int,
+        plane_height: int,
+        threshold_value: int,
+        soma_centre_value: int,
+        ball_xy_size: int = 3,
+        ball_z_size: int = 3,
+    ):
+        self.ball_z_size = ball_z_size
+        # The whole plane is a single tile
+        self.good_tiles_mask = np.ones((1, 1), dtype=bool)
+        self.ball_filter = BallFilter(
+            plane_width,
+            plane_height,
+            ball_xy_size,
+            ball_z_size,
+            overlap_fraction=0.8,
+            tile_step_width=plane_width,
+            tile_step_height=plane_height,
+            threshold_value=threshold_value,
+            soma_centre_value=soma_centre_value,
+        )
+        self.cell_detector = CellDetector(
+            plane_width, plane_height, start_z=ball_z_size // 2
+        )
+
+    def ball_filter_imgs(self, volume: np.ndarray) -> np.ndarray:
+        """
+        Ball filter *volume* in place, and return the centres of the
+        structures in the filtered volume.
+
+        Planes that the ball filter is not ready to filter yet are set to
+        zero.
+        """
+        self.ball_filter.reset()
+        self.cell_detector.reset(self.ball_z_size // 2)
+
+        previous_labels = None
+        for z in range(volume.shape[0]):
+            # Plane z is copied into the ball filter before it is
+            # overwritten, and later planes are only overwritten after
+            # being read.
+            self.ball_filter.append(volume[z], self.good_tiles_mask)
+            if self.ball_filter.ready:
+                self.ball_filter.walk()
+                middle_plane = self.ball_filter.get_middle_plane()
+                volume[z] = middle_plane
+                previous_labels = self.cell_detector.process(
+                    middle_plane, previous_labels
+                )
+        volume[: self.ball_z_size - 1] = 0
+        return self.cell_detector.get_cell_centres()
+
+
 def ball_filter_imgs(
     volume: np.ndarray,
     threshold_value: int,
@@ -49,60 +116,47 @@ def ball_filter_imgs(
     ball_xy_size: int = 3,
     ball_z_size: int = 3,
 ) -> Tuple[np.ndarray, np.ndarray]:
-    # OPTIMISE: reuse ball filter instance
-
-    good_tiles_mask = np.ones((1, 1, volume.shape[2]), dtype=bool)
-
-    plane_width, plane_height = volume.shape[:2]
-
-    bf = BallFilter(
-        plane_width,
-        plane_height,
-        ball_xy_size,
-        ball_z_size,
-        overlap_fraction=0.8,
-        tile_step_width=plane_width,
-        tile_step_height=plane_height,
-        threshold_value=threshold_value,
-        soma_centre_value=soma_centre_value,
-    )
-    cell_detector = CellDetector(
-        plane_width, plane_height, start_z=ball_z_size // 2
+    ball_filtered_volume = volume.astype(np.uint16)
+    splitter = StructureSplitter(
+        volume.shape[2],
+        volume.shape[1],
+        threshold_value,
+        soma_centre_value,
+        ball_xy_size=ball_xy_size,
+        ball_z_size=ball_z_size,
     )
-
-    # FIXME: hard coded type
-    ball_filtered_volume = np.zeros(volume.shape, dtype=np.uint16)
-    previous_plane = None
-    for z in range(volume.shape[2]):
-        bf.append(volume[:, :, z].astype(np.uint16), good_tiles_mask[:, :, z])
-        if bf.ready:
-            bf.walk()
-            middle_plane = bf.get_middle_plane()
-            ball_filtered_volume[:, :, z] = middle_plane[:]
-            # DEBUG: TEST: transpose
-            previous_plane = cell_detector.process(
-                middle_plane.copy(), previous_plane
-            )
-    return ball_filtered_volume, cell_detector.get_cell_centres()
+    cell_centres = splitter.ball_filter_imgs(ball_filtered_volume)
+    return ball_filtered_volume, cell_centres
 
 
 def iterative_ball_filter(
-    volume: np.ndarray, n_iter: int = 10
+    volume: np.ndarray, n_iter: int = 10, stop_early: bool = False
 ) -> Tuple[List[int], List[np.ndarray]]:
-    ns = []
+    """
+    Run the ball filter *n_iter* times over *volume*, and return the
+    number of structures, and their centres, after each run.
+
+    If *stop_early* is `True`, stop as soon as there are fewer structures
+    than after the previous run. This skips the remaining runs once the
+    number of structures has peaked, but misses a later, higher peak.
+    """
+    ns: List[int] = []
     centres = []
 
     threshold_value = 65534
     soma_centre_value = 65535
 
-    vol = volume.copy()  # TODO: check if required
+    vol = volume.astype(np.uint16)
+    splitter = StructureSplitter(
+        vol.shape[2], vol.shape[1], threshold_value, soma_centre_value
+    )
 
     for i in range(n_iter):
-        vol, cell_centres = ball_filter_imgs(
-            vol, threshold_value, soma_centre_value
-        )
+        cell_centres = splitter.ball_filter_imgs(vol)
         vol -= 1
         n_structures = len(cell_centres)
+        if stop_early and ns and n_structures < ns[-1]:
+            break
         ns.append(n_structures)
         centres.append(cell_centres)
         if n_structures == 0:
@@ -129,8 +183,16 @@ def check_centre_in_cuboid(centre: np.ndarray, max_coords: np.ndarray) -> bool:
 
 
 def split_cells(
-    cell_points: np.ndarray, outlier_keep: bool = False
+    cell_points: np.ndarray,
+    outlier_keep: bool = False,
+    stop_early: bool = False,
 ) -> np.ndarray:
+    """
+    Split a cluster of cells, and return the centres of the cells.
+
+    If *stop_early* is `True`, the ball filter stops being rerun once the
+    number of cells found starts to fall, see `iterative_ball_filter`.
+    """
     orig_centre = get_structure_centre(cell_points)
 
     xs = cell_points[:, 0]
@@ -159,7 +221,7 @@ def split_cells(
     vol = coords_to_volume(xs, ys, zs, ball_radius=ball_radius)
 
     # centres is a list of arrays of centres (1 array of centres per ball run)
-    ns, centres = iterative_ball_filter(vol)
+    ns, centres = iterative_ball_filter(vol, stop_early=stop_early)
     ns.insert(0, 1)
     centres.insert(0, np.array([relative_orig_centre]))
 
@@ -186,3 +248,42 @@ def split_cells(
     absolute_centres[:, 2] = orig_corner[2] + relative_centres[:, 2]
 
     return absolute_centres
+
+
+def split_cells_distance_transform(
+    cell_points: np.ndarray, min_distance: int, outlier_keep: bool = False
+) -> np.ndarray:
+    """
+    Split a cluster of cells, and return the centres of the cells.
+
+    This is a much faster alternative to `split_cells`. Cell centres are
+    the local maxima of the Euclidean distance from each point in the
+    cluster to the nearest point outside the cluster. The maxima are found
+    with `skimage.feature.peak_local_max`, which keeps only the highest
+    maximum within a cube of half-width *min_distance*, so any two centres
+    are more than *min_distance* pixels apart along at least one axis.
+
+    Centres are always points in the cluster, so *outlier_keep* has no
+    effect. It is accepted so this can be swapped with `split_cells`.
+    """
+    xs = cell_points[:, 0]
+    ys = cell_points[:, 1]
+    zs = cell_points[:, 2]
+
+    # Pad by one pixel, so that points on the edge of the cluster are next
+    # to the background
+    ball_radius = 1
+    mask = coords_to_volume(xs, ys, zs, ball_radius=ball_radius) != 0
+    distances = distance_transform_edt(mask)
+    peaks = peak_local_max(  # type: ignore[no-untyped-call]
+        distances, min_distance=max(int(min_distance), 1), exclude_border=False
+    )
+    if len(peaks) == 0:
+        return np.array([get_structure_centre(cell_points)])
+
+    # Peaks are (z, y, x) indices in the padded volume
+    absolute_centres = np.empty((len(peaks), 3))
+    absolute_centres[:, 0] = xs.min() + peaks[:, 2] - ball_radius
+    absolute_centres[:, 1] = ys.min() + peaks[:, 1] - ball_radius
+    absolute_centres[:, 2] = zs.min() + peaks[:, 0] - ball_radius
+    return absolute_centres
@@ -1,8 +1,18 @@
 import math
 import os
-from queue import Queue
-from threading import Lock
-from typing import Any, Callable, List, Optional, Tuple
+from collections import deque
+from multiprocessing.pool import AsyncResult, Pool
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import numpy as np
 from brainglobe_utils.cells.cells import Cell
@@ -13,13 +23,13 @@ from cellfinder_core import logger
 from cellfinder_core.detect.filters.setup_filters import (
     get_ball_filter,
     get_cell_detector,
+    get_cluster_splitter,
 )
 from cellfinder_core.detect.filters.volume.structure_detection import (
     get_structure_centre,
 )
 from cellfinder_core.detect.filters.volume.structure_splitting import (
     StructureSplitException,
-    split_cells,
 )
 
 
@@ -31,13 +41,18 @@ class VolumeFilter(object):
         soma_size_spread_factor: float = 1.4,
         setup_params: Tuple[np.ndarray, Any, int, int, float, Any],
         n_planes: int,
-        n_locks_release: int,
         save_planes: bool = False,
         plane_directory: Optional[str] = None,
         start_plane: int = 0,
         max_cluster_size: int = 5000,
         outlier_keep: bool = False,
         artifact_keep: bool = True,
+        n_ball_filter_threads: int = 1,
+        pack_planes: bool = False,
+        ball_filter_engine: str = "exact",
+        cluster_splitter: str = "ball",
+        cells_callback: Optional[Callable[[List[Cell]], None]] = None,
+        max_pending_splits: int = 8,
     ):
         self.soma_diameter = soma_diameter
         self.soma_size_spread_factor = soma_size_spread_factor
@@ -47,7 +62,6 @@ class VolumeFilter(object):
         self.plane_directory = plane_directory
         self.max_cluster_size = max_cluster_size
         self.outlier_keep = outlier_keep
-        self.n_locks_release = n_locks_release
 
         self.artifact_keep = artifact_keep
 
@@ -55,7 +69,24 @@ class VolumeFilter(object):
         self.threshold_value = None
         self.setup_params = setup_params
 
-        self.previous_plane: Optional[np.ndarray] = None
+        self.previous_labels: Optional[np.ndarray] = None
+        self.cells_callback = cells_callback
+        # Cells from structures that have been finalised
+        self.cells: List[Cell] = []
+        # Cells from finalised structures that haven't been passed on yet,
+        # as some of the structures are still being split
+        self.pending_cells: Deque[
+            List[Union[Cell, Tuple[int, AsyncResult]]]
+        ] = deque()
+        self.splitting_pool: Optional[Pool] = None
+        # Splits that have been sent to the splitting pool, and may not
+        # have finished yet. Each one holds a cluster's coordinates until it
+        # starts, so no more than max_pending_splits are sent at once.
+        self.pending_splits: Deque[AsyncResult] = deque()
+        self.max_pending_splits = max_pending_splits
+        self.max_cell_volume = sphere_volume(
+            self.soma_size_spread_factor * self.soma_diameter / 2
+        )
 
         self.ball_filter = get_ball_filter(
             plane=self.setup_params[0],
@@ -63,43 +94,60 @@ class VolumeFilter(object):
             ball_xy_size=self.setup_params[2],
             ball_z_size=self.setup_params[3],
             ball_overlap_fraction=self.setup_params[4],
+            n_threads=n_ball_filter_threads,
+            packed=pack_planes,
+            engine=ball_filter_engine,
+        )
+
+        self.split_cells = get_cluster_splitter(
+            soma_diameter=int(self.soma_diameter),
+            outlier_keep=self.outlier_keep,
+            engine=cluster_splitter,
         )
 
         self.cell_detector = get_cell_detector(
             plane_shape=self.setup_params[0].shape,  # type: ignore
             ball_z_size=self.setup_params[3],
             z_offset=self.setup_params[5],
+            # Structures this big are artifacts, which only need a centre
+            max_coords_size=max(
+                int(self.max_cluster_size), math.ceil(self.max_cell_volume)
+            ),
         )
 
     def process(
         self,
-        async_result_queue: Queue,
-        locks: List[Lock],
+        planes: Iterable[Tuple[np.ndarray, np.ndarray]],
         *,
         callback: Callable[[int], None],
+        splitting_pool: Optional[Pool] = None,
     ) -> List[Cell]:
+        """
+        Run the 3D filter and structure detection on the (plane, mask)
+        tuples from *planes*, and return the detected cells.
+
+        Each plane and mask is copied into the ball filter before the next
+        one is taken from *planes*, so *planes* can reuse their memory.
+
+        If *splitting_pool* is given, clusters of cells are split by the
+        workers in this pool. The detected cells are the same, and in the
+        same order, as splitting them in this process.
+
+        Cells are passed to the cells callback in the order that their
+        structures were finalised in, so a cluster that is being split
+        holds back the cells after it until the split is done. When
+        *max_pending_splits* splits are outstanding, this waits for the
+        oldest one before sending another, so the callback is never more
+        than that many clusters behind.
+        """
+        self.splitting_pool = splitting_pool
         progress_bar = tqdm(total=self.n_planes, desc="Processing planes")
-        for z in range(self.n_planes):
-            # Get result from the queue.
-            #
-            # It is important to remove the result from the queue here
-            # to free up memory once this plane has been processed by
-            # the 3D filter here
-            logger.debug(f"🏐 Waiting for plane {z}")
-            result = async_result_queue.get()
-            # .get() blocks until the result is available
-            plane, mask = result.get()
-            logger.debug(f"🏐 Got plane {z}")
+        for plane, mask in planes:
+            logger.debug(f"🏐 Got plane {self.z}")
 
             self.ball_filter.append(plane, mask)
 
             if self.ball_filter.ready:
-                # Let the next 2D filter run
-                z_release = z + self.n_locks_release + 1
-                if z_release < len(locks):
-                    logger.debug(f"🔓 Releasing lock for plane {z_release}")
-                    locks[z_release].release()
-
                 self._run_filter()
 
             callback(self.z)
@@ -119,8 +167,13 @@ class VolumeFilter(object):
             self.save_plane(middle_plane)
 
         logger.debug(f"🏫 Detecting structures for plane {self.z}")
-        self.previous_plane = self.cell_detector.process(
-            middle_plane, self.previous_plane
+        self.previous_labels = self.cell_detector.process(
+            middle_plane, self.previous_labels
+        )
+        # Structures not in this plane can't grow any more, so turn them
+        # into cells and free their coordinates
+        self._finalise_structures(
+            *self.cell_detector.pop_completed_structures()
         )
 
         logger.debug(f"🏫 Structures done for plane {self.z}")
@@ -132,20 +185,116 @@ class VolumeFilter(object):
             )
         plane_name = f"plane_{str(self.z).zfill(4)}.tif"
         f_path = os.path.join(self.plane_directory, plane_name)
-        tifffile.imsave(f_path, plane.T)
+        tifffile.imsave(f_path, plane)
+
+    def _finalise_structures(
+        self,
+        structures: Dict[int, np.ndarray],
+        large_structure_centres: Dict[int, np.ndarray],
+    ) -> None:
+        """
+        Convert complete structures to cells, and pass them on to
+        the cells callback.
+
+        If there is a splitting pool, clusters are split in the pool, and
+        their cells are passed on once they are ready. Cells are always
+        passed on in the order the structures were finalised in.
+
+        Parameters
+        ----------
+        structures :
+            Mapping from structure ID to the coordinates of its points.
+        large_structure_centres :
+            Mapping from structure ID to the centre of structures that are
+            too big to be cells, and don't keep their coordinates.
+        """
+        items = self._structures_to_cells(structures)
+        for cell_centre in large_structure_centres.values():
+            items.append(
+                Cell(
+                    (
+                        cell_centre[0],
+                        cell_centre[1],
+                        cell_centre[2],
+                    ),
+                    Cell.ARTIFACT,
+                )
+            )
+        self.pending_cells.append(items)
+        self._collect_cells(wait=False)
+
+    def _collect_cells(self, *, wait: bool) -> None:
+        """
+        Pass on the cells from finalised structures, in order, until
+        reaching structures that are still being split.
+
+        If *wait* is `True`, wait for all the structures to be split.
+        """
+        while self.pending_cells:
+            items = self.pending_cells[0]
+            if not wait and not all(
+                result.ready() for _, result in _split_results(items)
+            ):
+                return
+            self.pending_cells.popleft()
+
+            cells = []
+            for item in items:
+                if isinstance(item, Cell):
+                    cells.append(item)
+                else:
+                    cell_id, result = item
+                    try:
+                        cell_centres = result.get()
+                    except (ValueError, AssertionError) as err:
+                        raise StructureSplitException(
+                            f"Cell {cell_id}, error; {err}"
+                        )
+                    cells.extend(_centres_to_cells(cell_centres))
+            self.cells.extend(cells)
+            if cells and self.cells_callback is not None:
+                self.cells_callback(cells)
 
     def get_results(self) -> List[Cell]:
         logger.info("Splitting cell clusters and writing results")
+        self._finalise_structures(
+            self.cell_detector.get_coords_dict(),
+            self.cell_detector.get_large_structure_centres(),
+        )
+        self._collect_cells(wait=True)
+        self.pending_splits.clear()
+        return self.cells
 
-        max_cell_volume = sphere_volume(
-            self.soma_size_spread_factor * self.soma_diameter / 2
+    def _split_in_pool(self, cell_points: np.ndarray) -> AsyncResult:
+        """
+        Split the cluster *cell_points* in the splitting pool, first waiting
+        for the oldest split if there are already `max_pending_splits`.
+        """
+        assert self.splitting_pool is not None
+        while len(self.pending_splits) >= self.max_pending_splits:
+            self.pending_splits.popleft().wait()
+        while self.pending_splits and self.pending_splits[0].ready():
+            self.pending_splits.popleft()
+        result = self.splitting_pool.apply_async(
+            self.split_cells, args=(cell_points,)
         )
+        self.pending_splits.append(result)
+        return result
 
-        cells = []
-        for cell_id, cell_points in self.cell_detector.coords_maps.items():
+    def _structures_to_cells(
+        self, structures: Dict[int, np.ndarray]
+    ) -> List[Union[Cell, Tuple[int, AsyncResult]]]:
+        """
+        Convert structures to cells.
+
+        Clusters that are being split in the splitting pool are returned
+        as a (structure ID, result) tuple in place of their cells.
+        """
+        cells: List[Union[Cell, Tuple[int, AsyncResult]]] = []
+        for cell_id, cell_points in structures.items():
             cell_volume = len(cell_points)
 
-            if cell_volume < max_cell_volume:
+            if cell_volume < self.max_cell_volume:
                 cell_centre = get_structure_centre(cell_points)
                 cells.append(
                     Cell(
@@ -159,25 +308,18 @@ class VolumeFilter(object):
                 )
             else:
                 if cell_volume < self.max_cluster_size:
-                    try:
-                        cell_centres = split_cells(
-                            cell_points, outlier_keep=self.outlier_keep
+                    if self.splitting_pool is not None:
+                        cells.append(
+                            (cell_id, self._split_in_pool(cell_points))
                         )
+                        continue
+                    try:
+                        cell_centres = self.split_cells(cell_points)
                     except (ValueError, AssertionError) as err:
                         raise StructureSplitException(
                             f"Cell {cell_id}, error; {err}"
                         )
-                    for cell_centre in cell_centres:
-                        cells.append(
-                            Cell(
-                                (
-                                    cell_centre[0],
-                                    cell_centre[1],
-                                    cell_centre[2],
-                                ),
-                                Cell.UNKNOWN,
-                            )
-                        )
+                    cells.extend(_centres_to_cells(cell_centres))
                 else:
                     cell_centre = get_structure_centre(cell_points)
                     cells.append(
@@ -194,5 +336,28 @@ class VolumeFilter(object):
         return cells
 
 
+def _centres_to_cells(cell_centres: np.ndarray) -> List[Cell]:
+    """
+    Create cells of unknown type at the centres of split clusters.
+    """
+    return [
+        Cell(
+            (
+                cell_centre[0],
+                cell_centre[1],
+                cell_centre[2],
+            ),
+            Cell.UNKNOWN,
+        )
+        for cell_centre in cell_centres
+    ]
+
+
+def _split_results(
+    items: List[Union[Cell, Tuple[int, AsyncResult]]]
+) -> List[Tuple[int, AsyncResult]]:
+    return [item for item in items if not isinstance(item, Cell)]
+
+
 def sphere_volume(radius: float) -> float:
     return (4 / 3) * math.pi * radius**3
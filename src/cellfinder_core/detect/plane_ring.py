@@ -0,0 +1,142 @@
+from multiprocessing.shared_memory import SharedMemory
+from multiprocessing.util import Finalize
+from typing import Any, Dict, Tuple, Union
+
+import numpy as np
+import numpy.typing as npt
+
+# Shared memory blocks that this process has attached to, by name. Planes
+# are written by pool workers, which unpickle a new PlaneRing for every
+# plane, so each block is only attached to once per process.
+_attached_blocks: Dict[str, SharedMemory] = {}
+
+
+class PlaneRing:
+    """
+    A ring of slots in shared memory, that 2D filter workers write their
+    filtered planes and tile masks to.
+
+    Only the slot index is passed back to the 3D filter, which reads the
+    slot in place, instead of the plane being pickled and sent through the
+    pool's result pipe. Plane ``z`` is written to slot ``z % n_slots``, so
+    there must be no more than *n_slots* planes that have been released
+    for 2D filtering but not yet read by the 3D filter.
+
+    The ring can be pickled to pass it to workers, which then attach to
+    the same shared memory. Workers close the memory they attached to when
+    they exit normally (e.g. after ``Pool.close`` and ``Pool.join``), or
+    when `close_attached_blocks` is called. The process that created the
+    ring must call `close` once all the workers are done.
+    """
+
+    def __init__(
+        self,
+        n_slots: int,
+        plane_shape: Tuple[int, ...],
+        plane_dtype: npt.DTypeLike,
+        mask_shape: Tuple[int, ...],
+    ):
+        self.n_slots = n_slots
+        self.plane_shape = tuple(plane_shape)
+        self.plane_dtype = np.dtype(plane_dtype)
+        self.mask_shape = tuple(mask_shape)
+
+        planes_size = (
+            n_slots
+            * int(np.prod(self.plane_shape))
+            * self.plane_dtype.itemsize
+        )
+        masks_size = n_slots * int(np.prod(self.mask_shape))
+        self._planes_block = SharedMemory(
+            create=True, size=max(planes_size, 1)
+        )
+        self._masks_block = SharedMemory(create=True, size=max(masks_size, 1))
+        self._owner = True
+        self._set_arrays()
+
+    def _set_arrays(self) -> None:
+        self.planes: np.ndarray = np.ndarray(
+            (self.n_slots,) + self.plane_shape,
+            dtype=self.plane_dtype,
+            buffer=self._planes_block.buf,
+        )
+        self.masks: np.ndarray = np.ndarray(
+            (self.n_slots,) + self.mask_shape,
+            dtype=bool,
+            buffer=self._masks_block.buf,
+        )
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return {
+            "n_slots": self.n_slots,
+            "plane_shape": self.plane_shape,
+            "plane_dtype": self.plane_dtype,
+            "mask_shape": self.mask_shape,
+            "planes_name": self._planes_block.name,
+            "masks_name": self._masks_block.name,
+        }
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.n_slots = state["n_slots"]
+        self.plane_shape = state["plane_shape"]
+        self.plane_dtype = state["plane_dtype"]
+        self.mask_shape = state["mask_shape"]
+        self._planes_block = _attach(state["planes_name"])
+        self._masks_block = _attach(state["masks_name"])
+        self._owner = False
+        self._set_arrays()
+
+    def slot(self, z: int) -> int:
+        """
+        Get the index of the slot that plane *z* is written to.
+        """
+        return z % self.n_slots
+
+    def __getitem__(
+        self, slot: Union[int, slice]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Get the (plane, mask) arrays of slot *slot*, or the stacked arrays
+        of the slots in slice *slot*. These are views of the shared memory,
+        so are overwritten when the slots are reused.
+        """
+        return self.planes[slot], self.masks[slot]
+
+    def close(self) -> None:
+        """
+        Free the shared memory. Only the process that created the ring
+        should call this, after all the workers have finished with it.
+        """
+        if not self._owner:
+            raise RuntimeError("Only the owner of a PlaneRing can close it")
+        # Views of the shared memory have to be released first
+        del self.planes
+        del self.masks
+        for block in (self._planes_block, self._masks_block):
+            block.close()
+            block.unlink()
+
+
+def _attach(name: str) -> SharedMemory:
+    """
+    Attach to the shared memory block called *name*, reusing the block if
+    this process has already attached to it.
+    """
+    if not _attached_blocks:
+        # Close the blocks when this process exits
+        Finalize(None, close_attached_blocks, exitpriority=0)
+    if name not in _attached_blocks:
+        _attached_blocks[name] = SharedMemory(name=name)
+    return _attached_blocks[name]
+
+
+def close_attached_blocks() -> None:
+    """
+    Close all the shared memory blocks this process has attached to.
+
+    Any PlaneRing that was unpickled in this process can't be used after
+    this.
+    """
+    while _attached_blocks:
+        _, block = _attached_blocks.popitem()
+        block.close()
@@ -0,0 +1,132 @@
+import mmap
+from typing import Any, Dict, Optional, Tuple, Union
+
+import dask.array as da
+import numpy as np
+
+from cellfinder_core import types
+
+# The source that this process' 2D filter reads planes from. Pool workers
+# get it once, from the pool initializer, instead of with every plane.
+_worker_source: Optional["PlaneSource"] = None
+
+
+class MemmapPlaneSource:
+    """
+    Reads planes from a C-ordered stack stored in a file, given by its
+    path, data type, shape and byte offset.
+
+    Only the location of the stack is pickled, and the file is mapped
+    again in the process that reads the planes.
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        dtype: np.dtype,
+        shape: Tuple[int, ...],
+        offset: int,
+    ):
+        self.filename = filename
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(shape)
+        self.offset = offset
+        self._array: Optional[np.memmap] = None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        state["_array"] = None
+        return state
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, z: Union[int, slice]) -> np.ndarray:
+        """
+        Read plane *z*, or the planes in slice *z*, into a new (writable)
+        array.
+        """
+        if self._array is None:
+            self._array = np.memmap(
+                self.filename,
+                dtype=self.dtype,
+                mode="r",
+                offset=self.offset,
+                shape=self.shape,
+            )
+        return np.array(self._array[z])
+
+
+class DaskPlaneSource:
+    """
+    Reads planes from a dask array, in the process that reads the planes.
+    """
+
+    def __init__(self, array: da.Array):
+        self.array = array
+
+    def __len__(self) -> int:
+        return self.array.shape[0]
+
+    def __getitem__(self, z: Union[int, slice]) -> np.ndarray:
+        """
+        Read plane *z*, or the planes in slice *z*, into a new (writable)
+        array.
+        """
+        # Each worker reads its own planes, so don't start more threads
+        return np.array(self.array[z].compute(scheduler="synchronous"))
+
+
+PlaneSource = Union[MemmapPlaneSource, DaskPlaneSource]
+
+
+def get_plane_source(signal_array: types.array) -> Optional[PlaneSource]:
+    """
+    Get a source that 2D filter workers can read the planes of
+    *signal_array* from by their index, so that the planes don't have to be
+    read by the main process and sent to the workers.
+
+    This works for dask arrays, and C-contiguous numpy memmaps, including
+    views of part of a memmap. `None` is returned for other arrays, whose
+    planes have to be sent to the workers.
+    """
+    if isinstance(signal_array, da.Array):
+        return DaskPlaneSource(signal_array)
+
+    if not (
+        isinstance(signal_array, np.memmap) and signal_array.flags.c_contiguous
+    ):
+        return None
+    # Find the memmap that maps the file, which may be the base of a view
+    root = signal_array
+    while not isinstance(root.base, mmap.mmap):
+        if not isinstance(root.base, np.memmap):
+            return None
+        root = root.base
+    if root.filename is None:
+        return None
+    return MemmapPlaneSource(
+        root.filename,
+        signal_array.dtype,
+        signal_array.shape,
+        root.offset + signal_array.ctypes.data - root.ctypes.data,
+    )
+
+
+def set_worker_source(source: Optional[PlaneSource]) -> None:
+    """
+    Set the source that `read_planes` reads planes from in this process.
+    Used as a pool initializer.
+    """
+    global _worker_source
+    _worker_source = source
+
+
+def read_planes(start: int, stop: int) -> np.ndarray:
+    """
+    Read planes *start* to *stop* (exclusive) from this process' source,
+    set by `set_worker_source`.
+    """
+    if _worker_source is None:
+        raise RuntimeError("No plane source set for this process")
+    return _worker_source[start:stop]
@@ -45,6 +45,7 @@ def main(
     detect_callback: Optional[Callable[[int], None]] = None,
     classify_callback: Optional[Callable[[int], None]] = None,
     detect_finished_callback: Optional[Callable[[list], None]] = None,
+    backend: str = "processes",
 ) -> List:
     """
     Parameters
@@ -57,6 +58,9 @@ def main(
         Called with the batch number that has just finished.
     detect_finished_callback : Callable[list], optional
         Called after detection is finished with the list of detected points.
+    backend : str, optional
+        Run the 2D filter during detection in a pool of "processes" or of
+        "threads". See `cellfinder_core.detect.detect.main`.
     """
     suppress_tf_logging(tf_suppress_log_messages)
 
@@ -81,6 +85,7 @@ def main(
         log_sigma_size,
         n_sds_above_mean_thresh,
         callback=detect_callback,
+        backend=backend,
     )
 
     if detect_finished_callback is not None:
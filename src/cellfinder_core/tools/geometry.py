@@ -37,5 +37,15 @@ def make_sphere(
     return arr <= 1.0
 
 
+def sphere_points(centre: np.ndarray, radius: int) -> np.ndarray:
+    """
+    Return the integer (x, y, z) coordinates of the points within *radius*
+    of *centre*, as an (n, 3) array.
+    """
+    grid = np.indices((2 * radius + 1,) * 3).reshape(3, -1).T - radius
+    grid = grid[np.sum(grid**2, axis=1) <= radius**2]
+    return grid + centre
+
+
 def four_connected_kernel():
     return np.array([[0, 1, 0], [1, 1, 1], [0, 1, 0]], dtype=bool)
@@ -1,5 +1,8 @@
+from contextlib import contextmanager
 from pathlib import Path
+from typing import Iterator
 
+import numba
 from brainglobe_utils.general.exceptions import CommandLineInputError
 
 
@@ -80,3 +83,27 @@ def memory_in_bytes(memory_amount, unit):
         )
     else:
         return memory_amount * 10 ** supported_units[unit]
+
+
+@contextmanager
+def numba_threads(n_threads: int) -> Iterator[int]:
+    """
+    Run parallel numba functions called within the context with up to
+    *n_threads* threads.
+
+    The number of threads is capped at the number numba was started with,
+    and the previous number is restored on exit, so other parallel numba
+    code in the process is not affected.
+
+    :param n_threads: Maximum number of threads to use
+    :return: Number of threads used
+    """
+    n_threads = min(
+        n_threads, numba.config.NUMBA_NUM_THREADS  # type: ignore[attr-defined]
+    )
+    previous_n_threads = numba.get_num_threads()
+    numba.set_num_threads(n_threads)
+    try:
+        yield n_threads
+    finally:
+        numba.set_num_threads(previous_n_threads)
@@ -6,6 +6,7 @@ import numpy as np
 import pytest
 from brainglobe_utils.general.system import get_num_processes
 
+from cellfinder_core.detect import detect
 from cellfinder_core.main import main
 from cellfinder_core.tools.IO import read_with_dask
 
@@ -78,6 +79,34 @@ def test_detection_full(signal_array, background_array, n_free_cpus):
     )
 
 
+def test_cells_callback(signal_array):
+    # Cells should be passed to the callback as soon as they are found,
+    # and all of them should also be returned
+    callback_cells = []
+
+    def cells_callback(cells):
+        callback_cells.append(cells)
+
+    cells = detect.main(
+        signal_array,
+        0,
+        -1,
+        voxel_sizes,
+        16,
+        100000,
+        6,
+        15,
+        0.6,
+        1.4,
+        0,
+        0.2,
+        10,
+        cells_callback=cells_callback,
+    )
+    assert len(callback_cells) > 1
+    assert [cell for batch in callback_cells for cell in batch] == cells
+
+
 def test_detection_small_planes(
     signal_array, background_array, no_free_cpus, mocker
 ):
@@ -170,3 +199,82 @@ def test_data_dimension_error(ndim):
 
     with pytest.raises(ValueError, match="Input data must be 3D"):
         main(signal_array, background_array, voxel_sizes)
+
+
+def test_memmap_input(signal_array, tmp_path):
+    # Workers read planes from a memmap themselves, which should give the
+    # same cells as sending them planes from an in-memory array
+    def detect_cells(signal_array):
+        cells = detect.main(
+            signal_array,
+            0,
+            -1,
+            voxel_sizes,
+            16,
+            100000,
+            6,
+            15,
+            0.6,
+            1.4,
+            0,
+            0.2,
+            10,
+        )
+        return [(cell.x, cell.y, cell.z, cell.type) for cell in cells]
+
+    in_memory = np.asarray(signal_array)
+    memmap = np.lib.format.open_memmap(
+        tmp_path / "signal.npy",
+        mode="w+",
+        dtype=in_memory.dtype,
+        shape=in_memory.shape,
+    )
+    memmap[:] = in_memory
+    memmap.flush()
+
+    assert detect_cells(memmap) == detect_cells(in_memory)
+
+
+def test_threads_backend(signal_array):
+    # Running the 2D filter in threads should give the same cells as
+    # running it in processes
+    def detect_cells(backend):
+        cells = detect.main(
+            signal_array,
+            0,
+            -1,
+            voxel_sizes,
+            16,
+            100000,
+            6,
+            15,
+            0.6,
+            1.4,
+            0,
+            0.2,
+            10,
+            backend=backend,
+        )
+        return [(cell.x, cell.y, cell.z, cell.type) for cell in cells]
+
+    assert detect_cells("threads") == detect_cells("processes")
+
+
+def test_unknown_backend(signal_array):
+    with pytest.raises(ValueError, match="Unknown backend"):
+        detect.main(
+            signal_array,
+            0,
+            -1,
+            voxel_sizes,
+            16,
+            100000,
+            6,
+            15,
+            0.6,
+            1.4,
+            0,
+            0.2,
+            10,
+            backend="unknown",
+        )
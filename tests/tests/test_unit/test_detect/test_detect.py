@@ -1,23 +1,53 @@
 import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 
-from cellfinder_core.detect.detect import _map_with_locks
+import pytest
+
+from cellfinder_core.detect.detect import _map_ahead
 
 
 def add_one(a: int) -> int:
     return a + 1
 
 
-def test_map_with_locks():
-    args = [1, 2, 3, 2, 10]
+class ImmediatePool:
+    """
+    Runs tasks as soon as they are submitted, and records their arguments.
+    """
+
+    class Result:
+        def __init__(self, value):
+            self.value = value
 
-    with multiprocessing.Pool(2) as worker_pool:
-        result_queue, locks = _map_with_locks(add_one, args, worker_pool)
+        def get(self):
+            return self.value
 
-        async_results = [result_queue.get() for _ in range(len(args))]
-        assert len(async_results) == len(locks) == len(args)
+    def __init__(self):
+        self.submitted = []
 
-        for lock in locks:
-            lock.release()
+    def apply_async(self, func, args):
+        self.submitted.extend(args)
+        return self.Result(func(*args))
+
+
+@pytest.mark.parametrize("backend", ["processes", "threads"])
+def test_map_ahead(backend):
+    args = [1, 2, 3, 2, 10]
 
-        results = [res.get() for res in async_results]
-        assert results == [2, 3, 4, 3, 11]
+    if backend == "processes":
+        worker_pool = multiprocessing.get_context("spawn").Pool(2)
+    else:
+        worker_pool = ThreadPoolExecutor(2)
+    with worker_pool:
+        results = list(_map_ahead(add_one, args, worker_pool, 2))
+    assert results == [2, 3, 4, 3, 11]
+
+
+@pytest.mark.parametrize("n_ahead", [1, 3, 10])
+def test_map_ahead_bounded(n_ahead):
+    pool = ImmediatePool()
+    for i, result in enumerate(_map_ahead(add_one, range(8), pool, n_ahead)):
+        assert result == i + 1
+        # Only the tasks after this one that fit in the window have been
+        # submitted
+        assert pool.submitted == list(range(min(i + n_ahead, 8)))
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+from scipy.signal import medfilt2d
+from skimage.filters import gaussian
+
+from cellfinder_core.detect.filters.plane.classical_filter import (
+    FilterBuffers,
+    enhance_peaks,
+    median_filter_3x3,
+)
+
+
+@pytest.mark.parametrize("gaussian_sigma", [1.6, 3.2])
+def test_single_precision_enhance_peaks(gaussian_sigma):
+    # Bright blobs on a noisy background
+    rng = np.random.default_rng(0)
+    plane = rng.normal(size=(100, 120))
+    plane += 50 * (rng.random(plane.shape) > 0.995)
+    plane = gaussian(plane, 2)
+    plane -= plane.min()
+    plane = (60000 * plane / plane.max()).astype(np.uint16)
+
+    clipping_value = 65533
+    filtered = enhance_peaks(
+        plane.copy(), clipping_value, gaussian_sigma=gaussian_sigma
+    )
+    filtered_32 = enhance_peaks(
+        plane.copy(),
+        clipping_value,
+        gaussian_sigma=gaussian_sigma,
+        single_precision=True,
+    )
+    assert filtered_32.dtype == filtered.dtype
+    # Results are rounded to integers, so can differ by one more
+    np.testing.assert_allclose(
+        filtered_32, filtered, rtol=0, atol=1e-5 * clipping_value + 1
+    )
+
+
+@pytest.mark.parametrize("single_precision", [False, True])
+def test_enhance_peaks_reuse_buffers(single_precision):
+    rng = np.random.default_rng(0)
+    planes = rng.integers(0, 1000, size=(3, 30, 40), dtype=np.uint16)
+    buffers = FilterBuffers(planes[0].shape, planes.dtype, single_precision)
+    for plane in planes:
+        original = plane.copy()
+        expected = enhance_peaks(
+            plane, 65533, single_precision=single_precision
+        ).copy()
+        filtered = enhance_peaks(
+            plane, 65533, single_precision=single_precision, buffers=buffers
+        )
+        assert filtered is buffers.out
+        np.testing.assert_equal(filtered, expected)
+        np.testing.assert_equal(plane, original)
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16, np.int32])
+@pytest.mark.parametrize("shape", [(1, 1), (2, 5), (37, 23)])
+@pytest.mark.parametrize("n_threads", [1, 3])
+def test_median_filter_3x3(dtype, shape, n_threads):
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, np.iinfo(dtype).max, size=shape, dtype=dtype)
+    expected = medfilt2d(img.astype(np.float64))
+    filtered = median_filter_3x3(img, n_threads=n_threads)
+    assert filtered.dtype == dtype
+    np.testing.assert_equal(filtered, expected)
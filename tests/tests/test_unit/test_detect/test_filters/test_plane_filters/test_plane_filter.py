@@ -0,0 +1,152 @@
+import numpy as np
+import pytest
+
+from cellfinder_core.detect.filters.plane.plane_filter import (
+    TileProcessor,
+    get_filter_buffers,
+    get_mean_sd,
+    get_slab_size,
+)
+
+
+@pytest.mark.parametrize("dtype", [np.uint16, np.float32])
+def test_get_mean_sd(dtype):
+    rng = np.random.default_rng(0)
+    img = rng.normal(20000, 3000, size=(97, 131)).astype(dtype)
+    mean, sd = get_mean_sd(img)
+    np.testing.assert_allclose(mean, np.mean(img, dtype=np.float64))
+    np.testing.assert_allclose(sd, np.std(img, dtype=np.float64))
+
+
+@pytest.mark.parametrize("width", [40, 45])
+def test_get_tile_mask(width):
+    rng = np.random.default_rng(0)
+    plane = rng.integers(0, 1000, size=(50, width), dtype=np.uint16)
+    plane[rng.random(plane.shape) > 0.99] = 60000
+    tile_processor = TileProcessor(
+        clipping_value=65533,
+        threshold_value=65534,
+        soma_diameter=4,
+        log_sigma_size=0.2,
+        n_sds_above_mean_thresh=2,
+    )
+
+    thresholded, mask = tile_processor.get_tile_mask(plane.copy())
+    bright = thresholded == tile_processor.threshold_value
+    assert np.any(bright)
+    np.testing.assert_equal(thresholded[~bright], plane[~bright])
+
+    tile_processor.pack_planes = True
+    packed, packed_mask = tile_processor.get_tile_mask(plane.copy())
+    np.testing.assert_equal(packed, np.packbits(bright, axis=-1))
+    np.testing.assert_equal(packed_mask, mask)
+
+
+@pytest.mark.parametrize("pack_planes", [False, True])
+def test_get_tile_mask_out(pack_planes):
+    rng = np.random.default_rng(0)
+    plane = rng.integers(0, 1000, size=(50, 45), dtype=np.uint16)
+    plane[rng.random(plane.shape) > 0.99] = 60000
+    tile_processor = TileProcessor(
+        clipping_value=65533,
+        threshold_value=65534,
+        soma_diameter=4,
+        log_sigma_size=0.2,
+        n_sds_above_mean_thresh=2,
+        pack_planes=pack_planes,
+    )
+    expected_plane, expected_mask = tile_processor.get_tile_mask(plane.copy())
+
+    plane_shape, mask_shape = tile_processor.get_output_shapes(plane.shape)
+    out = (
+        np.empty(plane_shape, dtype=expected_plane.dtype),
+        np.empty(mask_shape, dtype=bool),
+    )
+    out_plane, out_mask = tile_processor.get_tile_mask(plane.copy(), out=out)
+    assert out_plane is out[0] and out_mask is out[1]
+    np.testing.assert_equal(out_plane, expected_plane)
+    np.testing.assert_equal(out_mask, expected_mask)
+
+
+@pytest.mark.parametrize("pack_planes", [False, True])
+@pytest.mark.parametrize("use_out", [False, True])
+def test_get_tile_mask_input_unchanged(pack_planes, use_out):
+    rng = np.random.default_rng(0)
+    plane = rng.integers(0, 1000, size=(50, 45), dtype=np.uint16)
+    plane[rng.random(plane.shape) > 0.99] = 65535
+    original = plane.copy()
+    tile_processor = TileProcessor(
+        clipping_value=65533,
+        threshold_value=65534,
+        soma_diameter=4,
+        log_sigma_size=0.2,
+        n_sds_above_mean_thresh=2,
+        pack_planes=pack_planes,
+    )
+    out = None
+    if use_out:
+        plane_shape, mask_shape = tile_processor.get_output_shapes(plane.shape)
+        out = (
+            np.empty(
+                plane_shape, dtype=np.uint8 if pack_planes else np.uint16
+            ),
+            np.empty(mask_shape, dtype=bool),
+        )
+
+    tile_processor.get_tile_mask(plane, out=out)
+    np.testing.assert_equal(plane, original)
+
+
+def test_filter_buffers_reused():
+    buffers = get_filter_buffers((10, 20), np.uint16, False)
+    assert get_filter_buffers((10, 20), np.uint16, False) is buffers
+    for args in [
+        ((20, 10), np.uint16, False),
+        ((10, 20), np.uint8, False),
+        ((10, 20), np.uint16, True),
+    ]:
+        other_buffers = get_filter_buffers(*args)
+        assert other_buffers is not buffers
+        assert other_buffers.fits(*args)
+
+
+@pytest.mark.parametrize("pack_planes", [False, True])
+def test_get_tile_masks(pack_planes):
+    # Filtering a slab of planes should give the same result as filtering
+    # each plane on its own
+    rng = np.random.default_rng(0)
+    planes = rng.integers(0, 1000, size=(3, 50, 45), dtype=np.uint16)
+    planes[rng.random(planes.shape) > 0.99] = 60000
+    tile_processor = TileProcessor(
+        clipping_value=65533,
+        threshold_value=65534,
+        soma_diameter=4,
+        log_sigma_size=0.2,
+        n_sds_above_mean_thresh=2,
+        pack_planes=pack_planes,
+    )
+
+    slab_planes, slab_masks = tile_processor.get_tile_masks(planes.copy())
+    assert len(slab_planes) == len(slab_masks) == len(planes)
+    for plane, slab_plane, slab_mask in zip(planes, slab_planes, slab_masks):
+        expected_plane, expected_mask = tile_processor.get_tile_mask(
+            plane.copy()
+        )
+        np.testing.assert_equal(slab_plane, expected_plane)
+        np.testing.assert_equal(slab_mask, expected_mask)
+
+
+@pytest.mark.parametrize(
+    "plane_shape, n_planes, n_workers, slab_size",
+    [
+        # Big planes are filtered one at a time
+        ((2048, 2048), 100, 4, 1),
+        ((1024, 512), 100, 4, 2),
+        ((64, 64), 2000, 4, 256),
+        # Every worker gets a slab
+        ((64, 64), 100, 4, 25),
+        ((64, 64), 2, 4, 1),
+    ],
+)
+def test_get_slab_size(plane_shape, n_planes, n_workers, slab_size):
+    assert get_slab_size(plane_shape, n_planes, n_workers) == slab_size
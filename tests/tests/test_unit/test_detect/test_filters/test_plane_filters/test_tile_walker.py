@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+from cellfinder_core.detect.filters.plane.tile_walker import TileWalker
+
+
+@pytest.mark.parametrize("shape", [(3, 3), (16, 16), (17, 33), (100, 130)])
+@pytest.mark.parametrize("soma_diameter", [2, 4])
+def test_mark_bright_tiles(shape, soma_diameter):
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 1000, size=shape, dtype=np.uint16)
+    img[rng.random(shape) > 0.7] += 3000
+
+    walker = TileWalker(img, soma_diameter)
+    walker.mark_bright_tiles()
+
+    # Tiles in the last row and column are skipped, even if they are
+    # complete
+    tile_size = 2 * soma_diameter
+    expected = np.zeros_like(walker.bright_tiles_mask)
+    for y in range(0, shape[0] - tile_size, tile_size):
+        for x in range(0, shape[1] - tile_size, tile_size):
+            tile = img[y : y + tile_size, x : x + tile_size]
+            expected[y // tile_size, x // tile_size] = (
+                np.mean(tile) >= walker.out_of_brain_threshold
+            )
+    np.testing.assert_equal(walker.bright_tiles_mask, expected)
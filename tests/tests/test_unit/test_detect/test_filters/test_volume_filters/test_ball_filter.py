@@ -0,0 +1,262 @@
+import numpy as np
+import pytest
+
+from cellfinder_core.detect.filters.setup_filters import get_ball_filter
+from cellfinder_core.detect.filters.volume.ball_filter import _cube_overlaps
+
+soma_diameter = 8
+ball_xy_size = 3
+
+
+@pytest.mark.parametrize("ball_z_size", [1, 3, 4])
+def test_ball_filter_planes_in_order(ball_z_size):
+    # Planes with no bright pixels are not modified by the filter, so the
+    # middle plane should always be the middle of the last ball_z_size
+    # planes that were appended
+    n_planes = 10
+    planes = np.random.randint(
+        low=0, high=1000, size=(n_planes, 30, 20), dtype=np.uint16
+    )
+    mask = np.ones((2, 2), dtype=bool)
+    bf = get_ball_filter(
+        plane=planes[0],
+        soma_diameter=soma_diameter,
+        ball_xy_size=ball_xy_size,
+        ball_z_size=ball_z_size,
+    )
+
+    for z, plane in enumerate(planes):
+        bf.append(plane, mask)
+        assert bf.ready == (z >= ball_z_size - 1)
+        if bf.ready:
+            bf.walk()
+            middle_z = z - (ball_z_size - 1) + ball_z_size // 2
+            np.testing.assert_equal(bf.get_middle_plane(), planes[middle_z])
+
+
+@pytest.mark.parametrize("n_threads", [2, 4])
+def test_ball_filter_parallel_same_marks(n_threads):
+    # Dense bright pixels, so that pixels marked earlier in the walk change
+    # whether later pixels are marked
+    rng = np.random.default_rng(seed=0)
+    planes = rng.integers(low=0, high=1000, size=(6, 50, 40), dtype=np.uint16)
+    planes[rng.random(planes.shape) < 0.55] = 65534
+    mask = np.ones((4, 3), dtype=bool)
+
+    middle_planes = []
+    for threads in [1, n_threads]:
+        bf = get_ball_filter(
+            plane=planes[0],
+            soma_diameter=soma_diameter,
+            ball_xy_size=5,
+            ball_z_size=3,
+            n_threads=threads,
+        )
+        middle_planes.append([])
+        for plane in planes:
+            bf.append(plane, mask)
+            if bf.ready:
+                bf.walk()
+                middle_planes[-1].append(bf.get_middle_plane())
+
+    serial, parallel = np.array(middle_planes)
+    assert np.any(serial == 65535)
+    np.testing.assert_equal(serial, parallel)
+
+
+@pytest.mark.parametrize("n_threads", [1, 2])
+def test_ball_filter_packed_same_marks(n_threads):
+    # Bit-packed planes only store the bright pixels, but should give the
+    # same marks. Use a width that isn't a multiple of 8.
+    rng = np.random.default_rng(seed=0)
+    planes = rng.integers(low=0, high=1000, size=(6, 50, 43), dtype=np.uint16)
+    planes[rng.random(planes.shape) < 0.55] = 65534
+    mask = np.ones((4, 3), dtype=bool)
+
+    middle_planes = []
+    for packed in [False, True]:
+        bf = get_ball_filter(
+            plane=planes[0],
+            soma_diameter=soma_diameter,
+            ball_xy_size=5,
+            ball_z_size=3,
+            n_threads=n_threads,
+            packed=packed,
+        )
+        middle_planes.append([])
+        for plane in planes:
+            if packed:
+                plane = np.packbits(plane >= bf.THRESHOLD_VALUE, axis=-1)
+            bf.append(plane, mask)
+            if bf.ready:
+                bf.walk()
+                middle_planes[-1].append(bf.get_middle_plane())
+
+    unpacked, packed = np.array(middle_planes)
+    assert np.any(unpacked == 65535)
+    unpacked[unpacked < 65534] = 0
+    np.testing.assert_equal(unpacked, packed)
+
+
+@pytest.mark.parametrize("packed", [False, True])
+def test_ball_filter_bright_counts(packed):
+    # The bright pixel counts are updated as planes are added and marked, so
+    # should always match the bright pixels in the planes being filtered
+    rng = np.random.default_rng(seed=0)
+    planes = rng.integers(low=0, high=1000, size=(8, 50, 43), dtype=np.uint16)
+    planes[rng.random(planes.shape) < 0.3] = 65534
+    mask = np.ones((4, 3), dtype=bool)
+    bf = get_ball_filter(
+        plane=planes[0],
+        soma_diameter=soma_diameter,
+        ball_xy_size=5,
+        ball_z_size=3,
+        packed=packed,
+    )
+
+    for plane in planes:
+        if packed:
+            plane = np.packbits(plane >= bf.THRESHOLD_VALUE, axis=-1)
+        bf.append(plane, mask)
+        if bf.ready:
+            bf.walk()
+            if packed:
+                bright = np.unpackbits(bf.volume, axis=-1, count=43)
+            else:
+                bright = bf.volume >= bf.THRESHOLD_VALUE
+            # Sum over each 16x16 tile
+            padded = np.zeros((3, 64, 48), dtype=np.int64)
+            padded[:, :50, :43] = bright
+            counts = padded.reshape(3, 4, 16, 3, 16).sum(axis=(2, 4))
+            np.testing.assert_equal(bf.tile_bright_counts, counts)
+            np.testing.assert_equal(
+                bf.window_bright_counts, counts.sum(axis=0)
+            )
+
+
+@pytest.mark.parametrize("packed", [False, True])
+@pytest.mark.parametrize("n_threads", [1, 2])
+def test_integral_ball_filter(packed, n_threads):
+    # The approximate filter should mark the inside of a single bright
+    # cube, and nothing outside of it
+    planes = np.zeros((3, 40, 30), dtype=np.uint16)
+    planes[:, 10:20, 12:22] = 65534
+    mask = np.ones((3, 2), dtype=bool)
+
+    bf = get_ball_filter(
+        plane=planes[0],
+        soma_diameter=soma_diameter,
+        ball_xy_size=5,
+        ball_z_size=3,
+        n_threads=n_threads,
+        packed=packed,
+        engine="integral",
+    )
+    for plane in planes:
+        if packed:
+            plane = np.packbits(plane >= bf.THRESHOLD_VALUE, axis=-1)
+        bf.append(plane, mask)
+    bf.walk()
+
+    marked = bf.get_middle_plane() == 65535
+    expected = np.zeros_like(marked)
+    expected[12:18, 14:20] = True
+    np.testing.assert_equal(marked[expected], True)
+    np.testing.assert_equal(marked[planes[1] == 0], False)
+    # The tile counts of BallFilter aren't used, so aren't kept up to date
+    np.testing.assert_equal(bf.window_bright_counts, 0)
+
+
+def test_integral_ball_filter_reset():
+    # After a reset, the filter should mark the same pixels as a new filter
+    rng = np.random.default_rng(seed=0)
+    planes = np.zeros((6, 40, 30), dtype=np.uint16)
+    planes[:3, 10:20, 12:22] = 65534
+    planes[3:][rng.random((3, 40, 30)) < 0.5] = 65534
+    mask = np.ones((3, 2), dtype=bool)
+
+    def get_middle_planes(bf, planes):
+        middle_planes = []
+        for plane in planes:
+            bf.append(plane, mask)
+            if bf.ready:
+                bf.walk()
+                middle_planes.append(bf.get_middle_plane())
+        return middle_planes
+
+    def make_filter():
+        return get_ball_filter(
+            plane=planes[0],
+            soma_diameter=soma_diameter,
+            ball_xy_size=5,
+            ball_z_size=3,
+            engine="integral",
+        )
+
+    bf = make_filter()
+    get_middle_planes(bf, planes[:3])
+    bf.reset()
+    # All zero planes shouldn't have any pixels marked
+    for middle_plane in get_middle_planes(bf, np.zeros_like(planes[:3])):
+        np.testing.assert_equal(middle_plane, 0)
+
+    bf.reset()
+    np.testing.assert_equal(
+        get_middle_planes(bf, planes[3:]),
+        get_middle_planes(make_filter(), planes[3:]),
+    )
+
+
+def test_unknown_ball_filter_engine():
+    with pytest.raises(ValueError, match="Unknown ball filter engine"):
+        get_ball_filter(
+            plane=np.zeros((20, 20), dtype=np.uint16),
+            soma_diameter=soma_diameter,
+            ball_xy_size=ball_xy_size,
+            ball_z_size=3,
+            engine="not an engine",
+        )
+
+
+@pytest.mark.parametrize("bright_fraction", [0.3, 0.6, 0.9])
+def test_cube_overlaps_early_exit(bright_fraction):
+    # Stopping early should give the same result as summing the kernel
+    # weight over all the bright pixels
+    ball_z_size = 5
+    bf = get_ball_filter(
+        plane=np.zeros((20, 20), dtype=np.uint16),
+        soma_diameter=soma_diameter,
+        ball_xy_size=ball_xy_size,
+        ball_z_size=ball_z_size,
+    )
+    z_map = np.arange(ball_z_size)
+    rng = np.random.default_rng(seed=0)
+    for _ in range(100):
+        cube = rng.integers(
+            low=0, high=1000, size=bf.kernel.shape, dtype=np.uint16
+        )
+        cube[rng.random(cube.shape) < bright_fraction] = bf.THRESHOLD_VALUE
+        expected = (
+            np.sum(bf.kernel[cube >= bf.THRESHOLD_VALUE])
+            > bf.overlap_threshold
+        )
+        assert (
+            _cube_overlaps(
+                cube,
+                0,
+                0,
+                cube.shape[2],
+                cube.shape[1],
+                False,
+                bf.overlap_threshold,
+                bf.THRESHOLD_VALUE,
+                bf.kernel_offsets,
+                bf.kernel_weights,
+                bf.remaining_kernel_weight,
+                z_map,
+                bf.middle_z_idx,
+                None,
+                0,
+            )
+            == expected
+        )
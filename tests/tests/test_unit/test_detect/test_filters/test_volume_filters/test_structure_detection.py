@@ -1,9 +1,12 @@
 import numpy as np
 import pytest
+from scipy import ndimage
 
 from cellfinder_core.detect.filters.volume.structure_detection import (
     CellDetector,
     Point,
+    _get_runs,
+    _label_runs,
     get_non_zero_dtype_min,
     get_structure_centre,
 )
@@ -19,6 +22,15 @@ def coords_to_points(coords_arrays):
     return coords
 
 
+def sort_points(coords):
+    # The order of points within a structure depends on the order
+    # structures were merged in, so compare them in a fixed order
+    return {
+        sid: sorted(points, key=lambda p: (p.z, p.y, p.x))
+        for sid, points in coords.items()
+    }
+
+
 @pytest.mark.parametrize(
     ("dtype", "expected"),
     [
@@ -65,7 +77,7 @@ depth = 2
 
 # Each item in the test data contains:
 #
-# - A list of indices to mark as structure pixels (ordering: [x, z, y])
+# - A list of indices to mark as structure pixels (ordering: [z, y, x])
 # - A dict of expected structure coordinates
 test_data = [
     (
@@ -75,12 +87,12 @@ test_data = [
     ),
     (
         # Two pixels connected in a single structure along x
-        [(0, 0, 0), (0, 1, 0)],
+        [(0, 0, 0), (0, 0, 1)],
         {1: [Point(0, 0, 0), Point(1, 0, 0)]},
     ),
     (
         # Two pixels connected in a single structure along y
-        [(0, 0, 0), (0, 0, 1)],
+        [(0, 0, 0), (0, 1, 0)],
         {1: [Point(0, 0, 0), Point(0, 1, 0)]},
     ),
     (
@@ -90,13 +102,13 @@ test_data = [
     ),
     (
         # Four pixels all connected and spread across x-y-z
-        [(0, 0, 0), (1, 0, 0), (1, 1, 0), (1, 0, 1)],
+        [(0, 0, 0), (1, 0, 0), (1, 0, 1), (1, 1, 0)],
         {1: [Point(0, 0, 0), Point(0, 0, 1), Point(1, 0, 1), Point(0, 1, 1)]},
     ),
     (
         # three initially disconnected pixels that then get merged
         # by a fourth pixel
-        [(1, 1, 0), (0, 1, 1), (1, 0, 1), (1, 1, 1)],
+        [(1, 0, 1), (0, 1, 1), (1, 1, 0), (1, 1, 1)],
         {
             1: [
                 Point(1, 1, 0),
@@ -108,7 +120,7 @@ test_data = [
     ),
     (
         # Three pixels in x-y plane that require structure merging
-        [(1, 0, 0), (0, 1, 0), (1, 1, 0)],
+        [(1, 0, 0), (0, 0, 1), (1, 0, 1)],
         {
             1: [
                 Point(1, 0, 0),
@@ -119,7 +131,7 @@ test_data = [
     ),
     (
         # Two disconnected single-pixel structures
-        [(0, 0, 0), (0, 2, 0)],
+        [(0, 0, 0), (0, 0, 2)],
         {1: [Point(0, 0, 0)], 2: [Point(2, 0, 0)]},
     ),
     (
@@ -133,7 +145,7 @@ test_data = [
 @pytest.mark.parametrize("dtype", [np.uint8, np.uint16, np.uint32, np.uint64])
 @pytest.mark.parametrize("pixels,expected_coords", test_data)
 def test_detection(dtype, pixels, expected_coords):
-    data = np.zeros((depth, width, height)).astype(dtype)
+    data = np.zeros((depth, height, width)).astype(dtype)
     detector = CellDetector(width, height, start_z=0)
 
     # This is the value used by BallFilter to mark pixels
@@ -141,9 +153,154 @@ def test_detection(dtype, pixels, expected_coords):
     for pix in pixels:
         data[pix] = max_poss_value
 
-    previous_plane = None
+    previous_labels = None
+    for plane in data:
+        previous_labels = detector.process(plane, previous_labels)
+
+    coords = detector.get_coords_dict()
+    assert sort_points(coords_to_points(coords)) == sort_points(
+        expected_coords
+    )
+    assert list(coords.keys()) == list(expected_coords.keys())
+
+
+def test_detection_many_merges():
+    # A comb with teeth along y, joined by a bar at the bottom of the
+    # last plane, so that many structures are merged together
+    dtype = np.uint32
+    data = np.zeros((3, 20, 30), dtype=dtype)
+    data[:, :, ::2] = np.iinfo(dtype).max
+    data[2, -1, :] = np.iinfo(dtype).max
+
+    detector = CellDetector(30, 20, start_z=0)
+    previous_labels = None
     for plane in data:
-        previous_plane = detector.process(plane, previous_plane)
+        previous_labels = detector.process(plane, previous_labels)
 
     coords = detector.get_coords_dict()
-    assert coords_to_points(coords) == expected_coords
+    assert list(coords.keys()) == [1]
+    points = coords[1]
+    assert len(points) == np.count_nonzero(data)
+    # Each point is only added once
+    assert len(np.unique(points, axis=0)) == len(points)
+
+
+def test_pop_completed_structures():
+    dtype = np.uint16
+    data = np.zeros((3, 2, 3), dtype=dtype)
+    value = np.iinfo(dtype).max
+    # Structure 1 is only in the first plane, structure 2 continues
+    # into the second plane
+    data[0, 0, 0] = value
+    data[0, 0, 2] = value
+    data[1, 0, 2] = value
+
+    detector = CellDetector(3, 2, start_z=0)
+    previous_labels = detector.process(data[0], None)
+    completed, large_completed = detector.pop_completed_structures()
+    assert len(completed) == 0 and len(large_completed) == 0
+
+    previous_labels = detector.process(data[1], previous_labels)
+    completed, _ = detector.pop_completed_structures()
+    assert coords_to_points(completed) == {1: [Point(0, 0, 0)]}
+    assert list(detector.get_coords_dict().keys()) == [2]
+
+    detector.process(data[2], previous_labels)
+    completed, _ = detector.pop_completed_structures()
+    assert sort_points(coords_to_points(completed)) == {
+        2: [Point(2, 0, 0), Point(2, 0, 1)]
+    }
+    assert len(detector.get_coords_dict()) == 0
+
+
+def test_many_structure_ids():
+    # Structure IDs larger than the plane dtype can hold should still
+    # connect to the right structure once earlier structures are popped
+    dtype = np.uint16
+    value = np.iinfo(dtype).max
+    data = np.zeros((4, 400, 700), dtype=dtype)
+    # 70000 single pixel structures, which are completed after plane 1
+    data[0, ::2, ::2] = value
+    # A new structure, with ID 70001, spanning the last two planes
+    data[2:, 0, 0] = value
+    n_structures = np.count_nonzero(data[0])
+    assert n_structures > np.iinfo(dtype).max
+
+    detector = CellDetector(700, 400, start_z=0)
+    previous_labels = None
+    for plane in data:
+        previous_labels = detector.process(plane, previous_labels)
+        assert previous_labels.dtype == np.int64
+        completed, _ = detector.pop_completed_structures()
+        if len(completed):
+            assert len(completed) == n_structures
+
+    # The input planes are left unchanged
+    assert np.count_nonzero(data) == n_structures + 2
+    assert sort_points(coords_to_points(detector.get_coords_dict())) == {
+        n_structures + 1: [Point(0, 0, 2), Point(0, 0, 3)]
+    }
+
+
+def test_max_coords_size():
+    # Structures with at least max_coords_size points should only keep
+    # their centre, which should be the same as with all the coordinates
+    dtype = np.uint16
+    rng = np.random.default_rng(seed=0)
+    data = np.zeros((6, 20, 30), dtype=dtype)
+    data[rng.random(data.shape) < 0.4] = np.iinfo(dtype).max
+    max_coords_size = 5
+
+    full_detector = CellDetector(30, 20, start_z=0)
+    detector = CellDetector(30, 20, start_z=0, max_coords_size=max_coords_size)
+    full_previous_labels = None
+    previous_labels = None
+    for plane in data:
+        full_previous_labels = full_detector.process(
+            plane.copy(), full_previous_labels
+        )
+        previous_labels = detector.process(plane.copy(), previous_labels)
+
+    full_coords = full_detector.get_coords_dict()
+    coords = detector.get_coords_dict()
+    centres = detector.get_large_structure_centres()
+    assert len(coords) > 0 and len(centres) > 0
+    assert sorted(list(coords.keys()) + list(centres.keys())) == list(
+        full_coords.keys()
+    )
+    for sid, points in full_coords.items():
+        if len(points) < max_coords_size:
+            assert sid not in centres
+            np.testing.assert_array_equal(
+                np.sort(coords[sid], axis=0), np.sort(points, axis=0)
+            )
+        else:
+            assert sid not in coords
+            np.testing.assert_array_equal(
+                centres[sid], get_structure_centre(points)
+            )
+
+
+@pytest.mark.parametrize("fraction", [0.2, 0.5, 0.8])
+def test_label_runs(fraction):
+    # Components should match 4-connected labelling, numbered in the
+    # raster order of their first pixel
+    rng = np.random.default_rng(seed=0)
+    bright = rng.random((40, 50)) < fraction
+    plane = np.where(bright, 255, 7).astype(np.uint8)
+
+    run_rows, run_starts, run_stops, row_starts = _get_runs(plane, 255)
+    # The plane is left unchanged
+    np.testing.assert_array_equal(plane, np.where(bright, 255, 7))
+    run_components, n_components = _label_runs(
+        run_starts, run_stops, row_starts
+    )
+
+    components = np.zeros(plane.shape, dtype=np.int64)
+    for y, start, stop, component in zip(
+        run_rows, run_starts, run_stops, run_components
+    ):
+        components[y, start:stop] = component + 1
+    expected, n_expected = ndimage.label(bright)
+    assert n_components == n_expected
+    np.testing.assert_array_equal(components, expected)
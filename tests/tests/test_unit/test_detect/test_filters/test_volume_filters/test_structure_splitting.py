@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from cellfinder_core.detect.filters.volume.structure_splitting import (
+    StructureSplitter,
+    ball_filter_imgs,
+    coords_to_volume,
+    iterative_ball_filter,
+    split_cells,
+    split_cells_distance_transform,
+)
+from cellfinder_core.tools.geometry import sphere_points
+
+
+@pytest.fixture
+def cluster():
+    # Two overlapping spheres
+    centre = np.array([10, 10, 10])
+    return np.unique(
+        np.concatenate(
+            [sphere_points(centre, 4), sphere_points(centre + [6, 0, 0], 4)]
+        ),
+        axis=0,
+    ).astype(np.uint64)
+
+
+def test_coords_to_volume(cluster):
+    ball_radius = 1
+    volume = coords_to_volume(
+        cluster[:, 0], cluster[:, 1], cluster[:, 2], ball_radius=ball_radius
+    )
+    expected = np.zeros(volume.shape, dtype=np.uint16)
+    relative = cluster - cluster.min(axis=0) + ball_radius
+    for x, y, z in relative:
+        expected[z, y, x] = 65534
+    np.testing.assert_equal(volume, expected)
+
+
+def test_splitter_reuse(cluster):
+    # Reusing a splitter should give the same results as a new filter and
+    # detector for each run
+    volume = coords_to_volume(cluster[:, 0], cluster[:, 1], cluster[:, 2])
+    splitter = StructureSplitter(
+        volume.shape[2], volume.shape[1], 65534, 65535
+    )
+    reused = volume.copy()
+    fresh = volume.copy()
+    for _ in range(3):
+        reused_centres = splitter.ball_filter_imgs(reused)
+        fresh, fresh_centres = ball_filter_imgs(fresh, 65534, 65535)
+        np.testing.assert_equal(reused, fresh)
+        np.testing.assert_equal(reused_centres, fresh_centres)
+        reused -= 1
+        fresh -= 1
+
+
+def test_stop_early(cluster):
+    volume = coords_to_volume(cluster[:, 0], cluster[:, 1], cluster[:, 2])
+    ns, centres = iterative_ball_filter(volume)
+    ns_early, centres_early = iterative_ball_filter(volume, stop_early=True)
+
+    assert len(ns_early) <= len(ns)
+    assert ns_early == ns[: len(ns_early)]
+    # Counts never fall before stopping
+    assert ns_early == sorted(ns_early)
+
+    split_centres = split_cells(cluster)
+    assert len(split_centres) > 1
+    if max(ns) == max(ns_early):
+        np.testing.assert_equal(
+            split_cells(cluster, stop_early=True), split_centres
+        )
+
+
+def test_split_cells_distance_transform(cluster):
+    centres = split_cells_distance_transform(cluster, min_distance=2)
+    centres = centres[np.argsort(centres[:, 0])]
+    np.testing.assert_allclose(centres, [[10, 10, 10], [16, 10, 10]], atol=1)
+
+    sphere = sphere_points(np.array([5, 6, 7]), 4).astype(np.uint64)
+    np.testing.assert_equal(
+        split_cells_distance_transform(sphere, min_distance=2), [[5, 6, 7]]
+    )
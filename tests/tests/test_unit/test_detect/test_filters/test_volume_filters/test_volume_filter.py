@@ -0,0 +1,114 @@
+import multiprocessing
+
+import numpy as np
+import pytest
+
+from cellfinder_core.detect.filters.volume.volume_filter import VolumeFilter
+from cellfinder_core.tools.geometry import sphere_points
+
+
+def make_volume_filter(**kwargs):
+    setup_params = (np.zeros((20, 30), dtype=np.uint16), 4, 3, 3, 0.6, 0)
+    return VolumeFilter(
+        soma_diameter=4,
+        setup_params=setup_params,
+        n_planes=1,
+        **kwargs,
+    )
+
+
+@pytest.fixture
+def structures():
+    # Single cells, and clusters of two overlapping cells
+    structures = {}
+    for i in range(6):
+        centre = np.array([10 + 20 * i, 10, 10])
+        if i % 2:
+            points = sphere_points(centre, 1)
+        else:
+            points = np.unique(
+                np.concatenate(
+                    [
+                        sphere_points(centre, 4),
+                        sphere_points(centre + [6, 0, 0], 4),
+                    ]
+                ),
+                axis=0,
+            )
+        structures[i + 1] = points.astype(np.uint64)
+    return structures
+
+
+def test_split_in_pool(structures):
+    # Splitting clusters in a pool should give the same cells, in the same
+    # order, as splitting them in this process
+    def get_cells(splitting_pool):
+        volume_filter = make_volume_filter()
+        volume_filter.splitting_pool = splitting_pool
+        volume_filter._finalise_structures(structures, {})
+        return [
+            (cell.x, cell.y, cell.z, cell.type)
+            for cell in volume_filter.get_results()
+        ]
+
+    serial_cells = get_cells(None)
+    assert len(serial_cells) > len(structures)
+    with multiprocessing.Pool(2) as pool:
+        assert get_cells(pool) == serial_cells
+
+
+def test_distance_cluster_splitter(structures):
+    volume_filter = make_volume_filter(cluster_splitter="distance")
+    volume_filter._finalise_structures(structures, {})
+    assert len(volume_filter.get_results()) > len(structures)
+
+
+def test_unknown_cluster_splitter():
+    with pytest.raises(ValueError, match="Unknown cluster splitter"):
+        make_volume_filter(cluster_splitter="unknown")
+
+
+def test_process_reused_planes():
+    # The planes passed to process() can reuse the same memory for every
+    # plane, as each plane is copied before the next one is taken
+    rng = np.random.default_rng(seed=0)
+    planes = rng.integers(0, 2, size=(8, 20, 30), dtype=np.uint16)
+    planes *= np.iinfo(np.uint16).max - 1
+    mask = np.ones((3, 4), dtype=bool)
+
+    def reuse_memory():
+        buffer = np.empty_like(planes[0])
+        for plane in planes:
+            buffer[:] = plane
+            yield buffer, mask
+
+    def get_cells(planes):
+        volume_filter = make_volume_filter()
+        cells = volume_filter.process(planes, callback=lambda z: None)
+        return [(cell.x, cell.y, cell.z, cell.type) for cell in cells]
+
+    cells = get_cells([(plane.copy(), mask) for plane in planes])
+    assert cells
+    assert get_cells(reuse_memory()) == cells
+
+
+def test_split_early_cluster(structures):
+    # A cluster found early on should be split, and its cells passed to the
+    # callback, while later structures are still being found. Waiting for
+    # the oldest split before sending another means the callback is never
+    # more than one cluster behind here.
+    batches = []
+    volume_filter = make_volume_filter(
+        cells_callback=batches.append, max_pending_splits=1
+    )
+    with multiprocessing.Pool(2) as pool:
+        volume_filter.splitting_pool = pool
+        # Clusters and single cells alternate, starting with a cluster
+        for cell_id, cell_points in structures.items():
+            volume_filter._finalise_structures({cell_id: cell_points}, {})
+        # Only the last cluster, and the cell after it, can be held back
+        assert len(batches) >= len(structures) - 2
+        cells = volume_filter.get_results()
+
+    assert len(batches) == len(structures)
+    assert [cell for batch in batches for cell in batch] == cells
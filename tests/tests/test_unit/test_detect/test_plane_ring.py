@@ -0,0 +1,47 @@
+import multiprocessing
+import pickle
+
+import numpy as np
+
+from cellfinder_core.detect import plane_ring as plane_ring_module
+from cellfinder_core.detect.plane_ring import PlaneRing, close_attached_blocks
+
+
+def write_plane(plane_ring: PlaneRing, z: int) -> int:
+    slot = plane_ring.slot(z)
+    plane, mask = plane_ring[slot]
+    plane[:] = z
+    mask[:] = z % 2
+    return slot
+
+
+def test_plane_ring():
+    plane_ring = PlaneRing(3, (4, 5), np.uint16, (2, 3))
+    try:
+        mp_ctx = multiprocessing.get_context("spawn")
+        with mp_ctx.Pool(2) as pool:
+            for z in range(5):
+                slot = pool.apply(write_plane, args=(plane_ring, z))
+                assert slot == z % 3
+                plane, mask = plane_ring[slot]
+                assert plane.shape == (4, 5) and plane.dtype == np.uint16
+                assert mask.shape == (2, 3) and mask.dtype == bool
+                np.testing.assert_equal(plane, z)
+                np.testing.assert_equal(mask, z % 2)
+    finally:
+        plane_ring.close()
+
+
+def test_close_attached_blocks():
+    plane_ring = PlaneRing(2, (4, 5), np.uint16, (2, 3))
+    try:
+        attached = pickle.loads(pickle.dumps(plane_ring))
+        attached[1][0][:] = 7
+        np.testing.assert_equal(plane_ring[1][0], 7)
+        assert len(plane_ring_module._attached_blocks) == 2
+
+        del attached
+        close_attached_blocks()
+        assert not plane_ring_module._attached_blocks
+    finally:
+        plane_ring.close()
@@ -0,0 +1,68 @@
+import multiprocessing
+import pickle
+
+import dask.array as da
+import numpy as np
+import pytest
+
+from cellfinder_core.detect.plane_source import (
+    DaskPlaneSource,
+    MemmapPlaneSource,
+    get_plane_source,
+    read_planes,
+    set_worker_source,
+)
+
+
+@pytest.fixture
+def stack():
+    return np.arange(6 * 4 * 5, dtype=np.uint16).reshape((6, 4, 5))
+
+
+@pytest.fixture
+def memmap_stack(tmp_path, stack):
+    # Put the stack after a header, to check the offset is used
+    path = tmp_path / "stack.raw"
+    with open(path, "wb") as f:
+        f.write(b"header")
+        f.write(stack.tobytes())
+    return np.memmap(path, dtype=stack.dtype, offset=6, shape=stack.shape)
+
+
+@pytest.mark.parametrize("start, end", [(0, 6), (2, 5)])
+def test_memmap_source(memmap_stack, stack, start, end):
+    source = get_plane_source(memmap_stack[start:end])
+    assert isinstance(source, MemmapPlaneSource)
+    # The file is mapped again after pickling
+    source = pickle.loads(pickle.dumps(source))
+    assert len(source) == end - start
+    for z in range(end - start):
+        plane = source[z]
+        np.testing.assert_equal(plane, stack[start + z])
+        assert plane.flags.writeable
+    np.testing.assert_equal(source[1:3], stack[start + 1 : start + 3])
+
+
+def test_dask_source(stack):
+    source = get_plane_source(da.from_array(stack, chunks=(1, 4, 5)))
+    assert isinstance(source, DaskPlaneSource)
+    assert len(source) == len(stack)
+    np.testing.assert_equal(source[3], stack[3])
+    np.testing.assert_equal(source[1:4], stack[1:4])
+
+
+def test_no_source(memmap_stack, stack):
+    assert get_plane_source(stack) is None
+    # Not contiguous
+    assert get_plane_source(memmap_stack[:, ::2]) is None
+
+
+def test_read_planes_in_worker(memmap_stack, stack):
+    mp_ctx = multiprocessing.get_context("spawn")
+    with mp_ctx.Pool(
+        2,
+        initializer=set_worker_source,
+        initargs=(get_plane_source(memmap_stack),),
+    ) as pool:
+        slabs = pool.starmap(read_planes, [(0, 2), (2, 3), (3, 6)])
+    np.testing.assert_equal(np.concatenate(slabs), stack)
@@ -12,3 +12,13 @@ def test_four_connected_kernel():
         geometry.four_connected_kernel(),
         np.array([[0, 1, 0], [1, 1, 1], [0, 1, 0]], dtype=bool),
     )
+
+
+def test_sphere_points():
+    points = geometry.sphere_points(np.array([5, 6, 7]), 2)
+    expected = np.argwhere(
+        geometry.make_sphere((5, 5, 5), 2, (2, 2, 2))
+    ) + np.array([3, 4, 5])
+    np.testing.assert_array_equal(
+        np.unique(points, axis=0), np.unique(expected, axis=0)
+    )
@@ -2,6 +2,7 @@ import os
 from math import isclose
 from pathlib import Path
 
+import numba
 import pytest
 from brainglobe_utils.general.exceptions import CommandLineInputError
 from brainglobe_utils.general.system import ensure_directory_exists
@@ -97,3 +98,16 @@ def test_memory_in_bytes():
 
     with pytest.raises(NotImplementedError):
         system.memory_in_bytes(1000, "ab")
+
+
+def test_numba_threads():
+    max_threads = numba.config.NUMBA_NUM_THREADS
+    n_threads = numba.get_num_threads()
+    with system.numba_threads(max_threads + 1) as used_threads:
+        assert used_threads == max_threads
+        assert numba.get_num_threads() == max_threads
+    assert numba.get_num_threads() == n_threads
+
+    with system.numba_threads(1) as used_threads:
+        assert used_threads == numba.get_num_threads() == 1
+    assert numba.get_num_threads() == n_threads